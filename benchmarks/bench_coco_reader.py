@@ -0,0 +1,87 @@
+#!/usr/bin/env python3
+"""
+Copyright (c) Raul Tapia
+Email: raultapia@us.es
+
+Permission is hereby granted, free of charge, to any person obtaining a copy of this software and associated documentation files (the "Software"), to deal in the Software without restriction, including without limitation the rights to use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of the Software, and to permit persons to whom the Software is furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+"""
+
+from annotaria import cocostream
+import argparse
+import concurrent.futures
+import json
+import os
+import random
+import resource
+import tempfile
+import time
+
+ANNOTATIONS_PER_IMAGE = 20
+
+
+def write_synthetic_coco(path, size):
+    rng = random.Random(0)
+
+    def images():
+        # Consumed after the annotations, once the number of images is known
+        for image_id in range(1, -(-counts[0] // ANNOTATIONS_PER_IMAGE) + 1):
+            yield {"height": 720, "width": 1280, "id": image_id, "file_name": f"{image_id:012d}.png"}
+
+    def annotations():
+        ann_id = 0
+        while f.tell() < size:
+            ann_id += 1
+            x, y = rng.uniform(0, 1200), rng.uniform(0, 650)
+            polygon = [round(v, 3) for _ in range(16) for v in (x + rng.uniform(0, 80), y + rng.uniform(0, 70))]
+            yield {"id": ann_id, "image_id": (ann_id - 1) // ANNOTATIONS_PER_IMAGE + 1, "category_id": rng.randrange(3), "bbox": [x, y, 80.0, 70.0], "segmentation": [polygon], "area": 5600, "iscrowd": 0, "track_id": rng.randrange(1000)}
+        counts.append(ann_id)
+
+    counts = []
+    with open(path, 'w', encoding='utf-8') as f:
+        cocostream.write_document(f, [("annotations", annotations()), ("images", images()), ("categories", [{"id": i, "name": f"class{i}"} for i in range(3)])])
+    return counts[0]
+
+
+def load_json(path):
+    t0 = time.perf_counter()
+    with open(path, 'r', encoding='utf-8') as f:
+        coco = json.load(f)
+    count = len(coco["annotations"])
+    return count, time.perf_counter() - t0, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def load_stream(path):
+    t0 = time.perf_counter()
+    count = sum(1 for _ in cocostream.iter_array(path, "annotations"))
+    return count, time.perf_counter() - t0, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def measure(fn, path):
+    # Every measurement runs in a fresh process, so its peak RSS is not inflated by the previous one
+    with concurrent.futures.ProcessPoolExecutor(max_workers=1) as executor:
+        return executor.submit(fn, path).result()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the peak memory of reading a COCO file with json.load and with the streaming reader.")
+    parser.add_argument("--size", type=float, default=4, help="Size of the synthetic COCO file in GB (default: 4).")
+    parser.add_argument("--output", "-o", default=None, help="Folder for the synthetic file (default: a temporary folder).")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory(dir=args.output) as tmp:
+        path = os.path.join(tmp, "synthetic.json")
+        count = write_synthetic_coco(path, int(args.size * 1e9))
+        print(f"Synthetic file: {os.path.getsize(path) / 1e9:.2f} GB, {count} annotations")
+
+        print(f"{'reader':<14}{'annotations':>14}{'time (s)':>12}{'peak RSS (MB)':>16}")
+        for name, fn in (("streaming", load_stream), ("json.load", load_json)):
+            n, elapsed, maxrss = measure(fn, path)
+            print(f"{name:<14}{n:>14}{elapsed:>12.1f}{maxrss / 1024:>16.1f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,93 @@
+#!/usr/bin/env python3
+"""
+Copyright (c) Raul Tapia
+Email: raultapia@us.es
+
+Permission is hereby granted, free of charge, to any person obtaining a copy of this software and associated documentation files (the "Software"), to deal in the Software without restriction, including without limitation the rights to use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of the Software, and to permit persons to whom the Software is furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+"""
+
+from annotaria.cocoviz import build_frames, draw_annotations, generate_colors, load_coco
+import argparse
+import json
+import numpy
+import os
+import random
+import statistics
+import tempfile
+import time
+
+
+def write_synthetic_coco(folder, n_annotations, n_images):
+    rng = random.Random(0)
+    images = [{"height": 1000, "width": 1000, "id": i + 1, "file_name": f"{i + 1:012d}.png"} for i in range(n_images)]
+    annotations = []
+    for i in range(n_annotations):
+        x, y = rng.uniform(0, 900), rng.uniform(0, 900)
+        segmentation = [[v for _ in range(8) for v in (x + rng.uniform(0, 100), y + rng.uniform(0, 100))]] if i % 2 else []
+        annotations.append({"id": i + 1, "image_id": rng.randrange(n_images) + 1, "category_id": rng.randrange(3), "bbox": [x, y, 100.0, 100.0], "segmentation": segmentation, "area": 10000, "iscrowd": 0, "track_id": i % 500, "is_interpolated": bool(i % 3 == 0)})
+    path = os.path.join(folder, "synthetic.json")
+    with open(path, 'w') as f:
+        json.dump({"images": images, "annotations": annotations, "categories": [{"id": i, "name": f"class{i}"} for i in range(3)]}, f)
+    # Only the listing of the images folder is needed, not the images themselves
+    os.makedirs(os.path.join(folder, "synthetic"))
+    for img in images:
+        open(os.path.join(folder, "synthetic", img["file_name"]), 'w').close()
+    return path
+
+
+def linear_scan_frame(coco, filenames, annotated_filenames, has_annotations, k):
+    # Annotation lookup of a frame before the index, in the default (non-skip) mode
+    img_data = coco['images']
+    return [ann for ann in coco['annotations'] if has_annotations[k] and ann['image_id'] == img_data[annotated_filenames.index(filenames[k])]['id']]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the frame-step latency of cocoviz.")
+    parser.add_argument("--annotations", "-n", type=int, default=100000, help="Number of annotations (default: 100000).")
+    parser.add_argument("--images", type=int, default=2000, help="Number of images (default: 2000).")
+    parser.add_argument("--frames", type=int, default=200, help="Number of frames stepped with the index (default: 200).")
+    parser.add_argument("--baseline-frames", type=int, default=3, help="Number of frames stepped with the linear scan (default: 3).")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        path = write_synthetic_coco(tmp, args.annotations, args.images)
+        images_folder = os.path.join(tmp, "synthetic")
+        canvas = numpy.zeros((1000, 1000, 3), dtype=numpy.uint8)
+
+        with open(path, 'r') as f:
+            coco = json.load(f)
+        color_list = generate_colors(len(coco['categories']), "RAINBOW")
+        filenames = sorted(os.listdir(images_folder))
+        annotated_filenames = sorted(x['file_name'] for x in coco['images'])
+        has_annotations = [x in annotated_filenames for x in filenames]
+        baseline = []
+        # Frames are spread over the sequence, since the cost of the linear scan grows with the position of the frame
+        for k in numpy.linspace(0, len(filenames) - 1, args.baseline_frames).astype(int):
+            t0 = time.perf_counter()
+            draw_annotations(canvas.copy(), linear_scan_frame(coco, filenames, annotated_filenames, has_annotations, k), coco['categories'], color_list, 1.0, False)
+            baseline.append(time.perf_counter() - t0)
+
+        t0 = time.perf_counter()
+        coco, ann_data = load_coco(path)
+        frames = build_frames(coco, images_folder, False)
+        load_time = time.perf_counter() - t0
+        indexed = []
+        for k in numpy.linspace(0, len(frames) - 1, args.frames).astype(int):
+            t0 = time.perf_counter()
+            img_file, image = frames[k]
+            draw_annotations(canvas.copy(), ann_data.get(image['id']) if image is not None else [], coco['categories'], color_list, 1.0, False)
+            indexed.append(time.perf_counter() - t0)
+        ann_data.close()
+
+        print(f"{args.annotations} annotations, {args.images} images, index built in {load_time:.2f} s")
+        print(f"{'lookup':<14}{'frames':>8}{'p50 (ms/frame)':>18}{'max (ms/frame)':>18}")
+        for name, times in (("linear scan", baseline), ("index", indexed)):
+            print(f"{name:<14}{len(times):>8}{statistics.median(times) * 1e3:>18.2f}{max(times) * 1e3:>18.2f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,70 @@
+#!/usr/bin/env python3
+"""
+Copyright (c) Raul Tapia
+Email: raultapia@us.es
+
+Permission is hereby granted, free of charge, to any person obtaining a copy of this software and associated documentation files (the "Software"), to deal in the Software without restriction, including without limitation the rights to use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of the Software, and to permit persons to whom the Software is furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+"""
+
+from annotaria.bag2images import decode_image
+import argparse
+import cv_bridge
+import genpy
+import numpy
+import os
+import rosbag
+import sensor_msgs.msg
+import tempfile
+import time
+
+ENCODINGS = {"mono8": (numpy.uint8, 1), "bgr8": (numpy.uint8, 3), "rgb8": (numpy.uint8, 3), "mono16": (numpy.uint16, 1), "bayer_rggb8": (numpy.uint8, 1)}
+
+
+def write_synthetic_bag(path, n, width, height):
+    rng = numpy.random.default_rng(0)
+    with rosbag.Bag(path, 'w') as bag:
+        for encoding, (dtype, channels) in ENCODINGS.items():
+            itemsize = numpy.dtype(dtype).itemsize
+            for i in range(n):
+                msg = sensor_msgs.msg.Image(height=height, width=width, encoding=encoding, is_bigendian=0, step=width * channels * itemsize)
+                msg.data = rng.integers(0, 255, height * msg.step, dtype=numpy.uint8).tobytes()
+                bag.write(f"/{encoding}", msg, genpy.Time(1 + i))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the per-frame decode cost of bag2images.")
+    parser.add_argument("--frames", "-n", type=int, default=200, help="Number of frames per encoding (default: 200).")
+    parser.add_argument("--width", type=int, default=1280, help="Frame width (default: 1280).")
+    parser.add_argument("--height", type=int, default=720, help="Frame height (default: 720).")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "synthetic.bag")
+        write_synthetic_bag(path, args.frames, args.width, args.height)
+
+        print(f"{'encoding':<14}{'cv_bridge (us/frame)':>24}{'fast path (us/frame)':>24}{'speedup':>10}")
+        with rosbag.Bag(path) as bag:
+            for encoding in ENCODINGS:
+                messages = [msg.message for msg in bag.read_messages(f"/{encoding}")]
+                fields = [{"height": m.height, "width": m.width, "encoding": m.encoding, "is_bigendian": m.is_bigendian, "step": m.step, "data": m.data} for m in messages]
+
+                t0 = time.perf_counter()
+                for m in messages:
+                    cv_image = cv_bridge.CvBridge().imgmsg_to_cv2(m, m.encoding)
+                    cv_image.astype(numpy.uint8)
+                before = (time.perf_counter() - t0) / len(messages) * 1e6
+
+                t0 = time.perf_counter()
+                for f in fields:
+                    decode_image(f)
+                after = (time.perf_counter() - t0) / len(fields) * 1e6
+
+                print(f"{encoding:<14}{before:>24.1f}{after:>24.1f}{before / after:>9.1f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,92 @@
+#!/usr/bin/env python3
+"""
+Copyright (c) Raul Tapia
+Email: raultapia@us.es
+
+Permission is hereby granted, free of charge, to any person obtaining a copy of this software and associated documentation files (the "Software"), to deal in the Software without restriction, including without limitation the rights to use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of the Software, and to permit persons to whom the Software is furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+"""
+
+from annotaria.cocoviz import Config, draw_annotations, draw_help, generate_colors
+import argparse
+import cv2
+import numpy
+import random
+import statistics
+import time
+
+
+def per_annotation_draw(img, anns, categories, color_list, scale, rotate, sleep):
+    # Drawing before batching: one OpenCV call per shape and dash, points rotated one at a time, help panel redrawn every frame
+    def rotate_point(p, shape):
+        if not isinstance(p[0], float):
+            p = p[0]
+        return shape[0] - p[1], shape[1] - p[0]
+
+    for ann in anns:
+        color = color_list[ann['category_id']]
+        x, y, w, h = [scale * x for x in ann['bbox']]
+        label = f"{categories[ann['category_id']]['name'].upper()} ({ann['category_id']})[{ann['track_id']}]"
+        if rotate:
+            x, y = map(lambda a, b: a - b, rotate_point([x, y], img.shape), (w, h))
+        cv2.putText(img, label, (int(x), int(y + h + 30)) if y < 20 else (int(x), int(y - 10)), cv2.FONT_HERSHEY_SIMPLEX, 0.75, color, 2)
+        if ann['segmentation']:
+            points = (scale * numpy.array(ann['segmentation'])).astype(numpy.int32).reshape(-1, 1, 2)
+            img = cv2.polylines(img, [numpy.array([rotate_point(x, img.shape) for x in points]) if rotate else points], True, color, 3)
+            cv2.rectangle(img, (int(x), int(y)), (int(x + w), int(y + h)), color, 1)
+        elif ann['is_interpolated']:
+            x1, y1, x2, y2 = int(x), int(y), int(x + w), int(y + h)
+            for i in range(x1, x2, 20):
+                cv2.line(img, (i, y1), (min(i + 10, x2), y1), color, 3)
+                cv2.line(img, (i, y2), (min(i + 10, x2), y2), color, 3)
+            for i in range(y1, y2, 20):
+                cv2.line(img, (x1, i), (x1, min(i + 10, y2)), color, 3)
+                cv2.line(img, (x2, i), (x2, min(i + 10, y2)), color, 3)
+        else:
+            cv2.rectangle(img, (int(x), int(y)), (int(x + w), int(y + h)), color, 3)
+
+    sub_img = img[img.shape[0] - 150:img.shape[0] - 20, 5:280]
+    img[img.shape[0] - 150:img.shape[0] - 20, 5:280] = cv2.addWeighted(sub_img, 0.5, numpy.zeros(sub_img.shape, dtype=numpy.uint8), 0.5, 1.0)
+    for i, line in enumerate(["Press D for next image", "Press A for previous image", "Press R to rotate the image", f"Press SPACE to {'play' if sleep else 'pause'} sequence", "Press ESC to exit"]):
+        cv2.putText(img, line, (10, img.shape[0] - 130 + 25 * i), cv2.FONT_HERSHEY_SIMPLEX, 0.5, (255, 255, 255), 1)
+    return img
+
+
+def batched_draw(img, anns, categories, color_list, scale, rotate, sleep):
+    return draw_help(draw_annotations(img, anns, categories, color_list, scale, rotate), sleep)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the per-frame draw time of cocoviz on dense frames.")
+    parser.add_argument("--annotations", "-n", type=int, default=300, help="Number of annotations per frame (default: 300).")
+    parser.add_argument("--frames", type=int, default=50, help="Number of frames drawn (default: 50).")
+    parser.add_argument("--rotate", "-r", action="store_true", help="Draw rotated frames.")
+    args = parser.parse_args()
+
+    rng = random.Random(0)
+    categories = [{"id": i, "name": f"class{i}"} for i in range(10)]
+    color_list = generate_colors(len(categories), "RAINBOW")
+    anns = []
+    for i in range(args.annotations):
+        x, y = rng.uniform(0, 1100), rng.uniform(0, 600)
+        segmentation = [[v for _ in range(24) for v in (x + rng.uniform(0, 150), y + rng.uniform(0, 100))]] if i % 3 == 0 else []
+        anns.append({"bbox": [x, y, rng.uniform(20, 150), rng.uniform(20, 100)], "segmentation": segmentation, "category_id": rng.randrange(len(categories)), "track_id": i, "is_interpolated": i % 3 == 1})
+    canvas = numpy.zeros((756, 1322, 3), dtype=numpy.uint8)
+    Config.ALWAYS_DRAW_BBOX = True
+
+    print(f"{'drawing':<16}{'p50 (ms/frame)':>18}")
+    for name, draw in (("per annotation", per_annotation_draw), ("batched", batched_draw)):
+        times = []
+        for _ in range(args.frames):
+            img = canvas.copy()
+            t0 = time.perf_counter()
+            draw(img, anns, categories, color_list, 1.0, args.rotate, True)
+            times.append(time.perf_counter() - t0)
+        print(f"{name:<16}{statistics.median(times) * 1e3:>18.2f}")
+
+
+if __name__ == "__main__":
+    main()
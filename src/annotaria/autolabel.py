@@ -10,39 +10,220 @@ The above copyright notice and this permission notice shall be included in all c
 THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
 """
 
+from annotaria import __version__, shards
 import argparse
+import concurrent.futures
+import contextlib
+import cv2
+import hashlib
 import json
 import os
+import resource
+import sys
+import threading
+import time
+import tqdm
+
+CACHE_FILE = ".autolabel.cache"
+
+# Hash, decode and write run on background threads and overlap with the other stages; wait is the time inference waited for decoding
+STAGES = ("hash", "decode", "wait", "preprocess", "inference", "postprocess", "tracking", "convert", "write")
+
+model = None
 
 
 def is_image(filename):
     return filename.lower().endswith(('.png', '.jpg', '.jpeg', '.bmp', '.tiff'))
 
 
-def run_yolo(image_folder, weight_file, conf_thresh):
+def load_model(weight_file):
     import warnings
     warnings.filterwarnings("ignore")
     from ultralytics import YOLO
     warnings.filterwarnings("default")
+    return YOLO(weight_file)
+
+
+def file_hash(path):
+    with open(path, 'rb') as f:
+        return hashlib.sha256(f.read()).hexdigest()
+
+
+def image_key(image_folder, filename, weights_hash, conf_thresh):
+    return f"{hashlib.sha256(shards.read_image(image_folder, filename)).hexdigest()}:{weights_hash}:{conf_thresh}"
+
+
+class Profiler:
+    def __init__(self):
+        self.stages = {}
+        self.lock = threading.Lock()
+
+    def add(self, stage, seconds):
+        with self.lock:
+            self.stages[stage] = self.stages.get(stage, 0.0) + seconds
+
+    @contextlib.contextmanager
+    def measure(self, stage):
+        t0 = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(stage, time.perf_counter() - t0)
+
+
+def load_cache(image_folder):
+    return {record["name"]: record["key"] for record in shards.read_records(os.path.join(image_folder, CACHE_FILE))}
+
+
+def reset_peak_rss():
+    # On Linux, the high-water mark of the process can be reset, so the peak of every folder is measured on its own
+    try:
+        with open("/proc/self/clear_refs", 'w') as f:
+            f.write("5")
+        return True
+    except OSError:
+        return False
+
+
+def peak_rss_mb(reset):
+    if reset:
+        with open("/proc/self/status", 'r') as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) / 1024
+    # Otherwise only the peak of the whole process is known; ru_maxrss is in bytes on macOS and in kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / (1024 * 1024 if sys.platform == "darwin" else 1024)
+
+
+def reset_tracker(model):
+    # Every sequence folder starts with a fresh tracker, as if the model had just been loaded
+    if model.predictor is not None:
+        for tracker in getattr(model.predictor, "trackers", []):
+            tracker.reset()
+
+
+def init_worker(weight_file, num_threads):
+    global model
+    # Pin the intra-op threads of each worker so that the workers together do not oversubscribe the cores
+    for var in ("OMP_NUM_THREADS", "MKL_NUM_THREADS", "OPENBLAS_NUM_THREADS"):
+        os.environ[var] = str(num_threads)
+    import torch
+    torch.set_num_threads(num_threads)
+    cv2.setNumThreads(num_threads)
+    model = load_model(weight_file)
 
-    model = YOLO(weight_file)
-    cnt = 0
-    for filename in sorted(os.listdir(image_folder)):
-        cnt += 1
-        if is_image(filename):
-            image_path = os.path.join(image_folder, filename)
-            result = model.track(image_path, persist=True, save=False)[0]
-            ret = {"shapes": [], "imagePath": filename, "imageData": None, "imageWidth": result.orig_shape[1], "imageHeight": result.orig_shape[0]}
-            for x in result:
-                if x.boxes.conf > conf_thresh:
-                    ret["shapes"].append({
-                        "label": x.names[int(x.boxes.cls)],
-                        "points": [[round(float(x.boxes.xyxy[0][0]), 12), round(float(x.boxes.xyxy[0][1]), 12)], [round(float(x.boxes.xyxy[0][2]), 12), round(float(x.boxes.xyxy[0][3]), 12)]],
-                        "group_id": int(x.boxes.id),
-                        "shape_type": "rectangle",
-                    })
-            with open(os.path.join(image_folder, f"{os.path.splitext(filename)[0]}.json"), "w") as f:
-                f.write(json.dumps(ret, indent=4))
+
+def label_folder(image_folder, *args):
+    return run_yolo(model, image_folder, *args)
+
+
+def result_to_shapes(result, conf_thresh):
+    # One device-to-host transfer per array instead of one tensor read per coordinate
+    boxes = result.boxes
+    keep = (boxes.conf > conf_thresh).cpu().numpy()
+    if not keep.any():
+        return []
+    labels = [result.names[c] for c in boxes.cls.cpu().numpy()[keep].astype(int).tolist()]
+    ids = boxes.id.cpu().numpy()[keep].astype(int).tolist() if boxes.id is not None else [None] * len(labels)
+    xyxy = boxes.xyxy.cpu().numpy()[keep].tolist()
+    return [{
+        "label": label,
+        "points": [[round(x0, 12), round(y0, 12)], [round(x1, 12), round(y1, 12)]],
+        "group_id": group_id,
+        "shape_type": "rectangle",
+    } for label, group_id, (x0, y0, x1, y1) in zip(labels, ids, xyxy)]
+
+
+def write_annotation(path, ret, compact=False):
+    with open(path, "w") as f:
+        f.write(json.dumps(ret, separators=(",", ":")) if compact else json.dumps(ret, indent=4))
+
+
+def run_yolo(model, image_folder, conf_thresh, batch_size=16, threads=4, weights_hash="", force_recompute=False, writers=2, compact=False):
+    profiler = Profiler()
+    folder_peak = reset_peak_rss()
+    reset_tracker(model)
+    filenames = [x for x in shards.list_images(image_folder) if is_image(x)]
+    cache = load_cache(image_folder)
+
+    def key(filename):
+        with profiler.measure("hash"):
+            return image_key(image_folder, filename, weights_hash, conf_thresh)
+
+    def decode(filename):
+        with profiler.measure("decode"):
+            return shards.imread(image_folder, filename)
+
+    def write(filename, ret):
+        with profiler.measure("write"):
+            write_annotation(os.path.join(image_folder, f"{os.path.splitext(filename)[0]}.json"), ret, compact)
+
+    def complete(done):
+        # Images enter the cache only once their annotation is on disk
+        for future in done:
+            future.result()
+            filename = writes.pop(future)
+            cache_file.write(json.dumps({"name": filename, "key": keys[filename]}) + "\n")
+
+    writes = {}
+    t0 = time.perf_counter()
+    with concurrent.futures.ThreadPoolExecutor(max_workers=threads) as executor, concurrent.futures.ThreadPoolExecutor(max_workers=writers) as writer, contextlib.ExitStack() as stack:
+        # Track ids are only consistent within a whole sequence, so the folder is skipped only if the content, weights and threshold of every
+        # image match the cache and every annotation exists; otherwise the whole sequence is inferred again with a fresh tracker
+        keys = dict(zip(filenames, executor.map(key, filenames)))
+        if not force_recompute and keys == cache and all(os.path.isfile(os.path.join(image_folder, f"{os.path.splitext(x)[0]}.json")) for x in filenames):
+            filenames = []
+        # The cache is rewritten from scratch, so removed images do not remain in it and an interrupted run leaves it incomplete
+        cache_file = stack.enter_context(open(os.path.join(image_folder, CACHE_FILE), 'w', buffering=1)) if filenames else None
+
+        batches = [filenames[i:i + batch_size] for i in range(0, len(filenames), batch_size)]
+        progress = tqdm.tqdm(total=len(filenames), desc=image_folder, unit="image", colour="yellow")
+
+        # The next batch is decoded in the background while the current one runs inference
+        images = [executor.submit(decode, filename) for filename in batches[0]] if batches else []
+        for k, batch in enumerate(batches):
+            with profiler.measure("wait"):
+                current = [x.result() for x in images]
+            images = [executor.submit(decode, filename) for filename in batches[k + 1]] if k + 1 < len(batches) else []
+            with profiler.measure("track"):
+                results = model.track(current, persist=True, save=False, verbose=False)
+            for filename, result in zip(batch, results):
+                for stage in ("preprocess", "inference", "postprocess"):
+                    profiler.add(stage, result.speed[stage] / 1e3)
+                with profiler.measure("convert"):
+                    ret = {"shapes": result_to_shapes(result, conf_thresh), "imagePath": filename, "imageData": None, "imageWidth": result.orig_shape[1], "imageHeight": result.orig_shape[0]}
+                writes[writer.submit(write, filename, ret)] = filename
+            complete([x for x in writes if x.done()])
+            if len(writes) > 4 * batch_size:
+                complete(concurrent.futures.wait(writes, return_when=concurrent.futures.FIRST_COMPLETED).done)
+            progress.update(len(batch))
+        complete(concurrent.futures.wait(writes).done)
+        progress.close()
+
+    # Tracking runs as a callback of the predictor, outside of the timed preprocess, inference and postprocess stages
+    profiler.stages["tracking"] = max(0.0, profiler.stages.pop("track", 0.0) - sum(profiler.stages.get(x, 0.0) for x in ("preprocess", "inference", "postprocess")))
+    elapsed = time.perf_counter() - t0
+    return {
+        "folder": image_folder,
+        "images": len(filenames),
+        "skipped": len(keys) - len(filenames),
+        "seconds": elapsed,
+        "images_per_second": len(filenames) / elapsed if elapsed > 0 else 0.0,
+        "peak_rss_mb": peak_rss_mb(folder_peak),
+        "peak_rss_scope": "folder" if folder_peak else "process",
+        "stages": {stage: profiler.stages.get(stage, 0.0) for stage in STAGES},
+    }
+
+
+def print_metrics(metrics):
+    header = f"{'folder':<40}{'images':>8}{'skipped':>9}{'img/s':>8}" + "".join(f"{stage:>12}" for stage in STAGES) + f"{'peak RSS (MB)':>15}"
+    print(header)
+    print("-" * len(header))
+    for m in metrics:
+        folder = m["folder"] if len(m["folder"]) <= 38 else "..." + m["folder"][-35:]
+        print(f"{folder:<40}{m['images']:>8}{m['skipped']:>9}{m['images_per_second']:>8.1f}" + "".join(f"{m['stages'][stage]:>11.2f}s" for stage in STAGES) + f"{m['peak_rss_mb']:>15.0f}")
+    if any(m["peak_rss_scope"] == "process" for m in metrics):
+        print("The peak RSS is the peak of the whole process, since it cannot be reset for every folder on this platform.")
 
 
 def main():
@@ -51,6 +232,13 @@ def main():
     parser.add_argument('--confidence', '-c', type=float, default=0.5, help='Confidence threshold for YOLO (default: 0.5)')
     parser.add_argument('--weights', '-w', type=str, default='yolo11n.pt', help='Path to YOLO weights file (default: "yolo11n.pt" (pretrained))')
     parser.add_argument('--force', '-f', action='store_true', help='Skip warning and proceed without confirmation')
+    parser.add_argument('--batch-size', '-b', type=int, default=16, help='Number of images per inference batch (default: 16)')
+    parser.add_argument('--force-recompute', '-r', action='store_true', help='Run inference on every image, ignoring the annotation cache')
+    parser.add_argument('--threads', '-t', type=int, default=4, help='Number of threads decoding the next batch in the background (default: 4)')
+    parser.add_argument('--jobs', '-j', type=int, default=1, help='Number of worker processes, each labeling whole sequence folders with its own model (default: 1)')
+    parser.add_argument('--writers', type=int, default=2, help='Number of threads writing the annotation files in the background (default: 2)')
+    parser.add_argument('--compact', action='store_true', help='Write compact annotation files without indentation')
+    parser.add_argument('--metrics', '-m', type=str, default=None, help='Append the per-folder timing metrics to this JSON lines file')
     args = parser.parse_args()
 
     for arg in args.folders:
@@ -66,10 +254,29 @@ def main():
                 print("\033[91;1mOperation cancelled.\033[0m")
                 exit(1)
 
+    if args.jobs < 1:
+        raise Exception(f"{args.jobs} is not a valid number of jobs.")
+
+    folders = []
     for path in args.folders:
         path = os.path.abspath(path)
-        for folder in [os.path.join(path, x) for x in os.listdir(path) if os.path.isdir(os.path.join(path, x))]:
-            run_yolo(folder, args.weights, args.confidence)
+        folders.extend([os.path.join(path, x) for x in os.listdir(path) if os.path.isdir(os.path.join(path, x))])
+
+    if args.jobs > 1 and not os.path.isfile(args.weights):
+        load_model(args.weights)  # Download pretrained weights once instead of once per worker
+    weights_hash = file_hash(args.weights) if os.path.isfile(args.weights) else args.weights
+    if args.jobs > 1:
+        with concurrent.futures.ProcessPoolExecutor(max_workers=args.jobs, initializer=init_worker, initargs=(args.weights, max(1, os.cpu_count() // args.jobs))) as executor:
+            metrics = [future.result() for future in [executor.submit(label_folder, folder, args.confidence, args.batch_size, args.threads, weights_hash, args.force_recompute, args.writers, args.compact) for folder in folders]]
+    else:
+        model = load_model(args.weights)
+        metrics = [run_yolo(model, folder, args.confidence, args.batch_size, args.threads, weights_hash, args.force_recompute, args.writers, args.compact) for folder in folders]
+
+    print_metrics(metrics)
+    if args.metrics is not None:
+        with open(args.metrics, 'a') as f:
+            for m in metrics:
+                f.write(json.dumps({"version": __version__, "weights": args.weights, "weights_hash": weights_hash, "confidence": args.confidence, "batch_size": args.batch_size, "jobs": args.jobs, **m}) + "\n")
 
 
 if __name__ == "__main__":
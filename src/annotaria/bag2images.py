@@ -10,43 +10,213 @@ The above copyright notice and this permission notice shall be included in all c
 THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
 """
 
+from annotaria.shards import DUPLICATES_FILE, ShardWriter, read_records
+import argparse
+import concurrent.futures
 import cv_bridge
 import cv2
+import genpy
+import json
 import numpy
 import os
+import queue
 import rosbag
-import sys
+import sensor_msgs.msg
+import threading
 import tqdm
-import argparse
+
+MANIFEST_FILE = ".bag2images.manifest"
+
+# Encodings that can be viewed directly as a numpy array: (dtype, channels)
+ENCODINGS = {"mono8": (numpy.uint8, 1), "bgr8": (numpy.uint8, 3), "rgb8": (numpy.uint8, 3), "mono16": (numpy.uint16, 1)}
+ENCODINGS.update({f"bayer_{pattern}8": (numpy.uint8, 1) for pattern in ("rggb", "bggr", "gbrg", "grbg")})
+ENCODINGS.update({f"bayer_{pattern}16": (numpy.uint16, 1) for pattern in ("rggb", "bggr", "gbrg", "grbg")})
+
+bridge = None
+
+
+def init_worker():
+    global bridge
+    bridge = cv_bridge.CvBridge()
+
+
+def decode_image(fields):
+    if fields["encoding"] not in ENCODINGS:
+        return None
+    dtype, channels = ENCODINGS[fields["encoding"]]
+    dtype = numpy.dtype(dtype).newbyteorder(">" if fields["is_bigendian"] else "<")
+    shape = (fields["height"], fields["width"]) + ((channels,) if channels > 1 else ())
+    strides = (fields["step"], channels * dtype.itemsize) + ((dtype.itemsize,) if channels > 1 else ())
+    # View over the message buffer; the row stride comes from the message step, so padded rows need no copy
+    cv_image = numpy.ndarray(shape, dtype, buffer=fields["data"], strides=strides)
+    if not dtype.isnative:
+        cv_image = cv_image.astype(dtype.newbyteorder("="))
+    return cv_image
+
+
+def convert_image(fields):
+    cv_image = decode_image(fields)
+    if cv_image is None:
+        msg = sensor_msgs.msg.Image(**fields)
+        cv_image = bridge.imgmsg_to_cv2(msg, msg.encoding)
+    return cv_image
+
+
+def write_image(fields, filename):
+    cv2.imwrite(filename, convert_image(fields))
+
+
+def encode_image(fields):
+    return cv2.imencode(".png", convert_image(fields))[1].tobytes()
+
+
+def frame_signature(cv_image):
+    # Downsampled grayscale thumbnail in 8-bit units; two frames are near-duplicates when their mean absolute difference is small
+    small = cv2.resize(cv_image, (32, 32), interpolation=cv2.INTER_AREA).astype(numpy.float32)
+    if small.ndim == 3:
+        small = small.mean(axis=2)
+    return small * (255 / numpy.iinfo(cv_image.dtype).max if cv_image.dtype.kind in "ui" else 1)
+
+
+def load_manifest(output_subpath):
+    return {record["timestamp"]: record for record in read_records(os.path.join(output_subpath, MANIFEST_FILE))}
+
+
+def remove_duplicates(output_subpath, timestamps):
+    # Frames extracted again are no longer duplicates of a kept frame
+    path = os.path.join(output_subpath, DUPLICATES_FILE)
+    records = [record for record in read_records(os.path.join(output_subpath, DUPLICATES_FILE)) if record["timestamp"] not in timestamps]
+    with open(f"{path}.tmp", 'w') as f:
+        for record in records:
+            f.write(json.dumps(record) + "\n")
+    os.replace(f"{path}.tmp", path)
+
+
+def read_messages(bag, topic, output_subpath, buffer, manifest, start_time, end_time, stride, progress, shards, dedup, errors):
+    # Frames dropped by a previous run are only skipped again when deduplicating with at least the threshold they were dropped with
+    recorded = {record["timestamp"]: record.get("dedup", float("inf")) for record in read_records(os.path.join(output_subpath, DUPLICATES_FILE))}
+    dropped = {timestamp for timestamp, threshold in recorded.items() if dedup is not None and threshold <= dedup}
+    restored = set()
+    duplicates = open(os.path.join(output_subpath, DUPLICATES_FILE), 'a', buffering=1) if dedup is not None else None
+    reader_bridge = cv_bridge.CvBridge()
+    kept = None  # Timestamp and signature of the last kept frame
+    try:
+        # Raw mode yields the serialized bytes, so messages filtered out here are never deserialized
+        for i, (_, (_, data, _, _, pytype), t) in enumerate(bag.read_messages(topic, start_time=start_time, end_time=end_time, raw=True)):
+            timestamp = str(t)
+            filename = os.path.join(output_subpath, f"{timestamp}.png")
+            if i % stride or timestamp in dropped:
+                progress.update(1)
+                continue
+            if timestamp in manifest and (os.path.basename(filename) in shards if shards is not None else os.path.isfile(filename)):
+                kept = None
+                progress.update(1)
+                continue
+            m = pytype()
+            m.deserialize(data)
+            fields = {"height": m.height, "width": m.width, "encoding": m.encoding, "is_bigendian": m.is_bigendian, "step": m.step, "data": bytes(m.data)}
+            if dedup is not None:
+                cv_image = decode_image(fields)
+                signature = frame_signature(cv_image if cv_image is not None else reader_bridge.imgmsg_to_cv2(m, m.encoding))
+                if kept is not None and numpy.abs(signature - kept[1]).mean() <= dedup:
+                    duplicates.write(json.dumps({"timestamp": timestamp, "kept": kept[0], "dedup": dedup}) + "\n")
+                    progress.update(1)
+                    continue
+                kept = (timestamp, signature)
+            if timestamp in recorded:
+                restored.add(timestamp)
+            buffer.put((fields, filename, timestamp))
+    except Exception as e:
+        errors.append(e)  # Raised again by the main thread once the frames already queued are written
+    finally:
+        if duplicates is not None:
+            duplicates.close()
+        if restored:
+            remove_duplicates(output_subpath, restored)
+        buffer.put(None)
+
+
+def extract_topic(bag, topic, output_subpath, executor, workers, progress, start_time=None, end_time=None, stride=1, shard_size=None, dedup=None):
+    manifest = load_manifest(output_subpath)
+    shards = ShardWriter(output_subpath, shard_size) if shard_size is not None else None
+
+    # Reader thread -> bounded queue -> process pool. At most 2 * workers frames are queued and 2 * workers are in flight.
+    buffer = queue.Queue(maxsize=2 * workers)
+    errors = []
+    reader = threading.Thread(target=read_messages, args=(bag, topic, output_subpath, buffer, manifest, start_time, end_time, stride, progress, shards, dedup, errors), daemon=True)
+    reader.start()
+
+    with open(os.path.join(output_subpath, MANIFEST_FILE), 'a', buffering=1) as f:
+        def complete(done):
+            for future in done:
+                record = pending.pop(future)
+                if shards is not None:
+                    shards.write(f"{record['timestamp']}.png", future.result())
+                else:
+                    future.result()
+                f.write(json.dumps(record) + "\n")
+                progress.update(1)
+
+        pending = {}
+        for fields, filename, timestamp in iter(buffer.get, None):
+            if len(pending) >= 2 * workers:
+                complete(concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED).done)
+            future = executor.submit(encode_image, fields) if shards is not None else executor.submit(write_image, fields, filename)
+            pending[future] = {"timestamp": timestamp, "bag": os.path.basename(bag.filename), "encoding": fields["encoding"]}
+        complete(concurrent.futures.wait(pending).done)
+    reader.join()
+    if shards is not None:
+        shards.close()
+    if errors:
+        raise errors[0]
 
 
 def main():
     parser = argparse.ArgumentParser(description="Process ROS bag files containing sensor_msgs/Image messages.")
     parser.add_argument("bag_files", metavar="BAG_FILE", type=str, nargs="+", help="Path to one or more ROS bag files (.bag) to process.")
+    parser.add_argument("--workers", "-j", type=int, default=os.cpu_count(), help="Number of worker processes used to convert and encode images (default: number of CPUs).")
+    parser.add_argument("--topics", "-t", type=str, nargs="+", default=None, help="Image topics to extract (default: all sensor_msgs/Image topics).")
+    parser.add_argument("--start", type=float, default=None, help="Start of the extraction window in seconds from the beginning of the bag.")
+    parser.add_argument("--end", type=float, default=None, help="End of the extraction window in seconds from the beginning of the bag.")
+    parser.add_argument("--stride", type=int, default=1, help="Extract only one out of every STRIDE messages (default: 1).")
+    parser.add_argument("--shards", "-s", action="store_true", help="Write frames into large tar shards with a timestamp index instead of one PNG file per message.")
+    parser.add_argument("--shard-size", type=int, default=1024, help="Maximum size of each shard in MB (default: 1024).")
+    parser.add_argument("--dedup", "-d", type=float, default=None, help="Drop frames whose mean absolute difference to the last kept frame is at most DEDUP gray levels (e.g. 2.0).")
     args = parser.parse_args()
 
     for arg in args.bag_files:
         if not (os.path.isfile(arg) and arg.endswith(".bag")):
             raise Exception(f"{arg} is not a valid bag file.")
 
-    for file in args.bag_files:
-        output_path = f"{os.path.abspath(file)[:-4]}"
-        os.system(f"mkdir -p {output_path}")
-
-        bag = rosbag.Bag(file)
-        topics = [key for (key, value) in bag.get_type_and_topic_info()[1].items() if value[0] == 'sensor_msgs/Image']
-        for topic in topics:
-            output_subpath = os.path.join(output_path, (topic[1:] if topic[0] == '/' else topic).replace('/', '_'))
-            os.system(f"mkdir -p {output_subpath}")
-            total_messages = bag.get_message_count(topic)
-            progress = tqdm.tqdm(total=bag.get_message_count(topic), desc=f"{file} ({topic})", unit="message", colour="yellow")
-            for msg in bag.read_messages(topic):
-                progress.update(1)
-                bridge = cv_bridge.CvBridge()
-                cv_image = bridge.imgmsg_to_cv2(msg.message, msg.message.encoding)
-                cv_image.astype(numpy.uint8)
-                cv2.imwrite(os.path.join(output_subpath, f"{str(msg.timestamp)}.png"), cv_image)
-        bag.close()
+    if args.workers < 1:
+        raise Exception(f"{args.workers} is not a valid number of workers.")
+
+    if args.stride < 1:
+        raise Exception(f"{args.stride} is not a valid stride.")
+
+    with concurrent.futures.ProcessPoolExecutor(max_workers=args.workers, initializer=init_worker) as executor:
+        for file in args.bag_files:
+            output_path = f"{os.path.abspath(file)[:-4]}"
+            os.makedirs(output_path, exist_ok=True)
+
+            bag = rosbag.Bag(file)
+            topics = [key for (key, value) in bag.get_type_and_topic_info()[1].items() if value[0] == 'sensor_msgs/Image']
+            if args.topics is not None:
+                for topic in args.topics:
+                    if topic not in topics:
+                        raise Exception(f"{topic} is not a sensor_msgs/Image topic of {file}.")
+                topics = args.topics
+            start_time = genpy.Time.from_sec(bag.get_start_time() + args.start) if args.start is not None else None
+            end_time = genpy.Time.from_sec(bag.get_start_time() + args.end) if args.end is not None else None
+
+            for topic in topics:
+                output_subpath = os.path.join(output_path, (topic[1:] if topic[0] == '/' else topic).replace('/', '_'))
+                os.makedirs(output_subpath, exist_ok=True)
+                total = bag.get_message_count(topic) if start_time is None and end_time is None else None
+                progress = tqdm.tqdm(total=total, desc=f"{file} ({topic})", unit="message", colour="yellow")
+                extract_topic(bag, topic, output_subpath, executor, args.workers, progress, start_time, end_time, args.stride, args.shard_size * 2**20 if args.shards else None, args.dedup)
+                progress.close()
+            bag.close()
 
 
 if __name__ == "__main__":
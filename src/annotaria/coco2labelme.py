@@ -10,136 +10,215 @@ The above copyright notice and this permission notice shall be included in all c
 THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
 """
 
+from annotaria import cocostream
 import tqdm
 import argparse
+import concurrent.futures
+import hashlib
+import itertools
 import json
 import labelme
 import numpy
 import os
 
+CHUNK_SIZE = 4096
 
-def check_if_circle(points):
-    if len(points) < 3:
-        return False
-    arr = numpy.array(points, dtype=float)
-    cx, cy = arr.mean(axis=0)
-    dists = numpy.sqrt((arr[:, 0] - cx)**2 + (arr[:, 1] - cy)**2)
-    return dists.std() < 1
-
-
-def check_if_line(points, tolerance=0.01):
-    if len(points) < 2:
-        return False
-    arr = numpy.array(points, dtype=float)
-    centroid = arr.mean(axis=0)
-    centered_points = arr - centroid
 
-    U, S, Vt = numpy.linalg.svd(centered_points, full_matrices=False)
-    if S[0] == 0:
-        return True
+def check_if_circle(arr):
+    # arr: (m, k, 2) stack of m polygons with the same number of vertices k >= 3
+    centroid = arr.mean(axis=1)
+    dists = numpy.sqrt((arr[:, :, 0] - centroid[:, 0:1])**2 + (arr[:, :, 1] - centroid[:, 1:2])**2)
+    return dists.std(axis=1) < 1
 
-    ratio = S[1] / S[0]
-    return ratio < tolerance
 
-
-def get_line_extremes(points):
-    arr = numpy.array(points, dtype=float)
-    centroid = arr.mean(axis=0)
+def check_if_line(arr, tolerance=0.01):
+    # arr: (m, k, 2) stack of m polylines with the same number of vertices k >= 2
+    # A single SVD per shape gives both the line test and the line extremes
+    centroid = arr.mean(axis=1, keepdims=True)
     centered = arr - centroid
     U, S, Vt = numpy.linalg.svd(centered, full_matrices=False)
-    direction = Vt[0]
-    t = numpy.dot(centered, direction)
-    t_min = t.min()
-    t_max = t.max()
-    point_min = centroid + t_min * direction
-    point_max = centroid + t_max * direction
-    return [[point_min[0], point_min[1]], [point_max[0], point_max[1]]]
-
-
-def coco2labelme(coco_json_path, images_folder):
-    with open(coco_json_path, 'r', encoding='utf-8') as f:
-        coco_data = json.load(f)
-
-    images = coco_data["images"]
-    annotations = coco_data["annotations"]
-    categories = coco_data["categories"]
-    cat_id_to_name = {cat["id"]: cat["name"] for cat in categories}
-    image_id_to_info = {}
-    image_id_to_shapes = {}
+    with numpy.errstate(divide='ignore', invalid='ignore'):
+        is_line = (S[:, 0] == 0) | (S[:, 1] / S[:, 0] < tolerance)
 
-    for img in images:
-        image_id_to_info[img["id"]] = img
-        image_id_to_shapes[img["id"]] = []
+    direction = Vt[:, 0]
+    t = numpy.matmul(centered, direction[:, :, None])[:, :, 0]
+    point_min = centroid[:, 0] + t.min(axis=1)[:, None] * direction
+    point_max = centroid[:, 0] + t.max(axis=1)[:, None] * direction
+    return is_line, numpy.stack([point_min, point_max], axis=1)
 
-    for ann in annotations:
-        image_id = ann["image_id"]
-        cat_id = ann["category_id"]
-        category_name = cat_id_to_name[cat_id]
-        group_id = ann["track_id"]
 
+def classify_shapes(annotations):
+    # Shapes are tested in bulk, grouping the candidates of each test by number of vertices
+    shapes = [None] * len(annotations)
+    groups = {}
+    for i, ann in enumerate(annotations):
         if ann["area"] < 3:
             points = ann["segmentation"][0] if len(ann["segmentation"]) > 0 else []
-            points = [points[i:i + 2] for i in range(0, len(points), 2)]
-            if check_if_line(points):
-                points = get_line_extremes(points)
-                shape_type = "line"
-            else:
-                x, y, w, h = ann["bbox"]
-                cx = x + w / 2
-                cy = y + h / 2
-                points = [[float(cx), float(cy)]]
-                shape_type = "point"
+            points = [points[j:j + 2] for j in range(0, len(points), 2)]
+            test = "line" if len(points) >= 2 else None
         elif len(ann["segmentation"]):
             points = ann["segmentation"][0]
-            points = [points[i:i + 2] for i in range(0, len(points), 2)]
-            shape_type = "polygon"
-            if check_if_circle(points):
-                x, y, w, h = ann["bbox"]
-                cx = x + w / 2
-                cy = y + h / 2
-                r = min(w, h) / 2
-                points = [[float(cx), float(cy)], [float(cx + r), float(cy)]]
-                shape_type = "circle"
+            points = [points[j:j + 2] for j in range(0, len(points), 2)]
+            shapes[i] = ("polygon", points)
+            test = "circle" if len(points) >= 3 else None
         else:
             x, y, w, h = ann["bbox"]
-            points = [[x, y], [x + w, y + h]]
-            shape_type = "rectangle"
-
-        shape = {
-            "label": category_name,
-            "points": [[round(coord, 12) for coord in point] for point in points],
-            "group_id": group_id,
-            "description": "",
-            "shape_type": shape_type,
-            "flags": {},
-            "mask": None
-        }
-
-        image_id_to_shapes[image_id].append(shape)
-
-    for image_id, img_info in tqdm.tqdm(image_id_to_info.items(), desc="Generating LabelMe annotations", unit="file", colour="yellow"):
-        shapes = image_id_to_shapes[image_id]
-
-        labelme_annotation = {
-            "version": labelme.__version__,
-            "flags": {},
-            "shapes": shapes,
-            "imagePath": img_info["file_name"],
-            "imageData": None,
-            "imageHeight": img_info["height"],
-            "imageWidth": img_info["width"]
-        }
-
-        out_fp = os.path.join(images_folder, f"{os.path.splitext(img_info['file_name'])[0]}.json")
-        os.makedirs(images_folder, exist_ok=True)
-        with open(out_fp, 'w', encoding='utf-8') as f:
-            json.dump(labelme_annotation, f, ensure_ascii=False, indent=2)
+            shapes[i] = ("rectangle", [[x, y], [x + w, y + h]])
+            test = None
+        if test is not None:
+            groups.setdefault((test, len(points)), []).append((i, points))
+
+    for (test, _), members in groups.items():
+        arr = numpy.array([points for _, points in members], dtype=float)
+        if test == "line":
+            is_line, extremes = check_if_line(arr)
+            for (i, _), line, points in zip(members, is_line, extremes):
+                if line:
+                    shapes[i] = ("line", [[points[0][0], points[0][1]], [points[1][0], points[1][1]]])
+        else:
+            for (i, _), circle in zip(members, check_if_circle(arr)):
+                if circle:
+                    x, y, w, h = annotations[i]["bbox"]
+                    cx = x + w / 2
+                    cy = y + h / 2
+                    r = min(w, h) / 2
+                    shapes[i] = ("circle", [[float(cx), float(cy)], [float(cx + r), float(cy)]])
+
+    for i, ann in enumerate(annotations):
+        if shapes[i] is None:
+            x, y, w, h = ann["bbox"]
+            cx = x + w / 2
+            cy = y + h / 2
+            shapes[i] = ("point", [[float(cx), float(cy)]])
+    return shapes
+
+
+def write_labelme_file(out_fp, labelme_annotation):
+    # Files whose content would not change are not rewritten, so their modification time is preserved
+    content = json.dumps(labelme_annotation, ensure_ascii=False, indent=2)
+    if os.path.isfile(out_fp):
+        with open(out_fp, 'r', encoding='utf-8') as f:
+            if hashlib.sha256(f.read().encode('utf-8')).digest() == hashlib.sha256(content.encode('utf-8')).digest():
+                return "skipped"
+    with open(out_fp, 'w', encoding='utf-8') as f:
+        f.write(content)
+    return "written"
+
+
+def is_labelme_file(path):
+    try:
+        with open(path, 'r', encoding='utf-8') as f:
+            data = json.load(f)
+    except (OSError, ValueError):
+        return False
+    return isinstance(data, dict) and "shapes" in data and "imagePath" in data
+
+
+def scan_coco(coco_json_path):
+    # Reads the images and categories, and checks whether the annotations of each image are contiguous
+    images, categories = [], []
+    grouped = True
+    finished, current = set(), None
+    for key, value in cocostream.iter_document(coco_json_path):
+        if key == "images":
+            images = list(value)
+        elif key == "categories":
+            categories = list(value)
+        elif key == "annotations":
+            for ann in value:
+                if ann["image_id"] != current:
+                    finished.add(current)
+                    current = ann["image_id"]
+                    grouped = grouped and current not in finished
+    return images, categories, grouped
+
+
+def iter_shapes(coco_json_path, cat_id_to_name, grouped):
+    # Yields the shapes of each image; when the annotations are grouped by image, an image is yielded as soon as its last annotation is read
+    image_id_to_shapes = {}
+    current = None
+    annotations = cocostream.iter_array(coco_json_path, "annotations")
+    while True:
+        chunk = list(itertools.islice(annotations, CHUNK_SIZE))
+        if not chunk:
+            break
+        for ann, (shape_type, points) in zip(chunk, classify_shapes(chunk)):
+            image_id = ann["image_id"]
+            if grouped and image_id != current:
+                if current is not None:
+                    yield current, image_id_to_shapes.pop(current)
+                current = image_id
+
+            shape = {
+                "label": cat_id_to_name[ann["category_id"]],
+                "points": [[round(coord, 12) for coord in point] for point in points],
+                "group_id": ann["track_id"],
+                "description": "",
+                "shape_type": shape_type,
+                "flags": {},
+                "mask": None
+            }
+
+            image_id_to_shapes.setdefault(image_id, []).append(shape)
+    yield from image_id_to_shapes.items()
+
+
+def coco2labelme(coco_json_path, images_folder, jobs=None, prune=False):
+    images, categories, grouped = scan_coco(coco_json_path)
+    cat_id_to_name = {cat["id"]: cat["name"] for cat in categories}
+    image_id_to_info = {img["id"]: img for img in images}
+
+    def iter_tasks():
+        pending = set(image_id_to_info)
+        for image_id, shapes in itertools.chain(iter_shapes(coco_json_path, cat_id_to_name, grouped), ((image_id, []) for image_id in image_id_to_info)):
+            if image_id not in pending:
+                continue
+            pending.discard(image_id)
+            img_info = image_id_to_info[image_id]
+            labelme_annotation = {
+                "version": labelme.__version__,
+                "flags": {},
+                "shapes": shapes,
+                "imagePath": img_info["file_name"],
+                "imageData": None,
+                "imageHeight": img_info["height"],
+                "imageWidth": img_info["width"]
+            }
+            yield os.path.join(images_folder, f"{os.path.splitext(img_info['file_name'])[0]}.json"), labelme_annotation
+
+    os.makedirs(images_folder, exist_ok=True)
+    stats = {"written": 0, "skipped": 0, "deleted": 0}
+    with concurrent.futures.ProcessPoolExecutor(max_workers=jobs) as executor, tqdm.tqdm(total=len(image_id_to_info), desc="Generating LabelMe annotations", unit="file", colour="yellow") as progress:
+        # Only a bounded number of images is in flight, so memory does not grow with the number of annotations
+        futures = set()
+        for out_fp, labelme_annotation in iter_tasks():
+            if len(futures) >= 4 * (jobs or os.cpu_count()):
+                done, futures = concurrent.futures.wait(futures, return_when=concurrent.futures.FIRST_COMPLETED)
+                for future in done:
+                    stats[future.result()] += 1
+                    progress.update(1)
+            futures.add(executor.submit(write_labelme_file, out_fp, labelme_annotation))
+        for future in concurrent.futures.as_completed(futures):
+            stats[future.result()] += 1
+            progress.update(1)
+
+    if prune:
+        expected = {f"{os.path.splitext(img_info['file_name'])[0]}.json" for img_info in image_id_to_info.values()}
+        for filename in sorted(os.listdir(images_folder)):
+            if filename.endswith(".json") and filename not in expected and is_labelme_file(os.path.join(images_folder, filename)):
+                os.remove(os.path.join(images_folder, filename))
+                stats["deleted"] += 1
+
+    print(f"LabelMe files: {stats['written']} written, {stats['skipped']} skipped (unchanged), {stats['deleted']} deleted")
+    return stats
 
 
 def main():
     parser = argparse.ArgumentParser(description="COCO visualizer.")
     parser.add_argument("json_file", help="Path to the JSON file.")
     parser.add_argument("images_folder", nargs="?", default=None, help="Optional path to the folder containing the images. If not provided, images path is obtained from the json path")
+    parser.add_argument("--jobs", "-j", type=int, default=os.cpu_count(), help="Number of worker processes writing the LabelMe files (default: number of CPUs).")
+    parser.add_argument("--prune", "-p", action="store_true", help="Delete LabelMe files of the images folder that do not correspond to any image of the JSON file.")
     args = parser.parse_args()
 
     if not os.path.isfile(args.json_file):
@@ -151,9 +230,12 @@ def main():
     if args.images_folder and not os.path.isdir(args.images_folder):
         raise Exception(f"{args.images_folder} is not a valid directory.")
 
+    if args.jobs < 1:
+        raise Exception(f"{args.jobs} is not a valid number of jobs.")
+
     print(f"JSON file: {args.json_file}")
     print(f"Images folder: {args.images_folder}")
-    coco2labelme(args.json_file, args.images_folder)
+    coco2labelme(args.json_file, args.images_folder, args.jobs, args.prune)
 
 
 if __name__ == "__main__":
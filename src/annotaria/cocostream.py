@@ -0,0 +1,175 @@
+#!/usr/bin/env python3
+"""
+Copyright (c) Raul Tapia
+Email: raultapia@us.es
+
+Permission is hereby granted, free of charge, to any person obtaining a copy of this software and associated documentation files (the "Software"), to deal in the Software without restriction, including without limitation the rights to use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of the Software, and to permit persons to whom the Software is furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+"""
+
+import array
+import json
+import tempfile
+import types
+
+CHUNK_SIZE = 1 << 20
+WHITESPACE = " \t\n\r"
+
+
+class Stream:
+    def __init__(self, f):
+        self.f = f
+        self.buf = ""
+        self.pos = 0
+        self.eof = False
+        self.decoder = json.JSONDecoder()
+
+    def fill(self):
+        # Reads at least as much as is already buffered, so a large value is decoded in a logarithmic number of attempts
+        chunk = self.f.read(max(CHUNK_SIZE, len(self.buf) - self.pos))
+        if not chunk:
+            self.eof = True
+            return False
+        self.buf = self.buf[self.pos:] + chunk
+        self.pos = 0
+        return True
+
+    def peek(self):
+        while True:
+            while self.pos < len(self.buf) and self.buf[self.pos] in WHITESPACE:
+                self.pos += 1
+            if self.pos < len(self.buf) or not self.fill():
+                return self.buf[self.pos] if self.pos < len(self.buf) else ""
+
+    def next_char(self, expected):
+        c = self.peek()
+        if c not in expected:
+            raise json.JSONDecodeError(f"Expecting one of {list(expected)}", self.buf, self.pos)
+        self.pos += 1
+        return c
+
+    def value(self):
+        self.peek()
+        while True:
+            try:
+                obj, end = self.decoder.raw_decode(self.buf, self.pos)
+                # A number at the end of the buffer, or cut after its decimal point or exponent mark, may continue in the next chunk
+                number = isinstance(obj, (int, float)) and not isinstance(obj, bool)
+                if self.eof or (end < len(self.buf) and not (number and self.buf[end] in ".eE+-")):
+                    self.pos = end
+                    return obj
+            except json.JSONDecodeError:
+                if self.eof:
+                    raise
+            self.fill()
+
+    def items(self):
+        if self.peek() == "]":
+            self.pos += 1
+            return
+        while True:
+            yield self.value()
+            if self.next_char(",]") == "]":
+                return
+
+
+def iter_document(path):
+    # Yields the (key, value) members of a JSON object; arrays are yielded as iterators over their elements, which are decoded one at a time
+    with open(path, 'r', encoding='utf-8') as f:
+        stream = Stream(f)
+        stream.next_char("{")
+        if stream.peek() == "}":
+            return
+        while True:
+            key = stream.value()
+            stream.next_char(":")
+            if stream.peek() == "[":
+                stream.pos += 1
+                items = stream.items()
+                yield key, items
+                for _ in items:
+                    pass  # Skip the elements the caller did not consume
+            else:
+                yield key, stream.value()
+            if stream.next_char(",}") == "}":
+                return
+
+
+def iter_array(path, key):
+    for k, value in iter_document(path):
+        if k == key:
+            yield from value
+            return
+
+
+def read_values(path, keys):
+    # Reads the given members, skipping the other ones without materializing them
+    values = {}
+    for k, value in iter_document(path):
+        if k in keys:
+            values[k] = list(value) if isinstance(value, types.GeneratorType) else value
+    return values
+
+
+class AnnotationStore:
+    # Spills annotations to a temporary JSON lines file grouped by one of their fields, so only the annotations of one group are held in memory
+    def __init__(self, field):
+        self.field = field
+        self.file = tempfile.TemporaryFile()
+        self.offsets = {}
+        self.size = 0
+        self.reading = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def __len__(self):
+        return sum(len(offsets) for offsets in self.offsets.values())
+
+    def add(self, ann):
+        if self.reading:
+            self.file.seek(0, 2)
+            self.reading = False
+        data = (json.dumps(ann) + "\n").encode('utf-8')
+        self.offsets.setdefault(ann.get(self.field), array.array('q')).append(self.size)
+        self.file.write(data)
+        self.size += len(data)
+
+    def keys(self):
+        return self.offsets.keys()
+
+    def get(self, key):
+        self.reading = True
+        anns = []
+        for offset in self.offsets.get(key, ()):
+            self.file.seek(offset)
+            anns.append(json.loads(self.file.readline()))
+        return anns
+
+    def close(self):
+        self.file.close()
+
+
+def write_document(f, members, ensure_ascii=True):
+    # Writes the (key, value) members exactly as json.dump(..., indent=2) would; list or iterator values are streamed element by element
+    f.write("{")
+    first = True
+    for key, value in members:
+        f.write(("," if not first else "") + "\n  " + json.dumps(key, ensure_ascii=ensure_ascii) + ": ")
+        first = False
+        if isinstance(value, (dict, str, int, float, bool, type(None))):
+            f.write(json.dumps(value, ensure_ascii=ensure_ascii, indent=2).replace("\n", "\n  "))
+        else:
+            count = 0
+            f.write("[")
+            for item in value:
+                f.write(("," if count else "") + "\n    " + json.dumps(item, ensure_ascii=ensure_ascii, indent=2).replace("\n", "\n    "))
+                count += 1
+            f.write("\n  ]" if count else "]")
+    f.write("\n}" if not first else "}")
@@ -10,28 +10,52 @@ The above copyright notice and this permission notice shall be included in all c
 THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
 """
 
+from annotaria import cocostream, shards
 import argparse
+import collections
+import concurrent.futures
+import contextlib
 import cv2
 import dataclasses
 import enum
+import functools
 import json
 import numpy
 import os
+import threading
+import time
+import tqdm
 
+VIDEO_EXTENSIONS = (".mp4", ".avi", ".mkv")
+TIMING_STAGES = ("decode", "resize", "load", "draw", "display", "wait")
+HELP_PANEL = (-150, -20, 5, 280)  # Rows relative to the bottom of the frame, and columns
 
-def dashed_rectangle(img, pt1, pt2, color, thickness=1, dash_length=10):
-    x1, y1 = pt1
-    x2, y2 = pt2
-    for i in range(x1, x2, dash_length * 2):
-        cv2.line(img, (i, y1), (min(i + dash_length, x2), y1), color, thickness)
-        cv2.line(img, (i, y2), (min(i + dash_length, x2), y2), color, thickness)
-    for i in range(y1, y2, dash_length * 2):
-        cv2.line(img, (x1, i), (x1, min(i + dash_length, y2)), color, thickness)
-        cv2.line(img, (x2, i), (x2, min(i + dash_length, y2)), color, thickness)
+
+def dashed_segments(x1, y1, x2, y2, dash_length=10):
+    # Dashes of many rectangles at once, as the endpoints of the lines a loop over range(start, end, 2 * dash_length) would draw, and the rectangle of each dash
+    x1, y1, x2, y2 = (numpy.asarray(v, dtype=numpy.int64).reshape(-1) for v in (x1, y1, x2, y2))
+
+    def dashes(start, end):
+        count = numpy.maximum(0, -((start - end) // (2 * dash_length)))
+        owner = numpy.repeat(numpy.arange(len(start)), count)
+        begin = start[owner] + 2 * dash_length * (numpy.arange(len(owner)) - (numpy.cumsum(count) - count)[owner])
+        return owner, begin, numpy.minimum(begin + dash_length, end[owner])
+
+    h, hb, he = dashes(x1, x2)
+    v, vb, ve = dashes(y1, y2)
+    segments = numpy.concatenate([
+        numpy.stack([hb, y1[h], he, y1[h]], axis=1),
+        numpy.stack([hb, y2[h], he, y2[h]], axis=1),
+        numpy.stack([x1[v], vb, x1[v], ve], axis=1),
+        numpy.stack([x2[v], vb, x2[v], ve], axis=1)
+    ]).reshape(-1, 2, 2).astype(numpy.int32)
+    return segments, numpy.concatenate([h, h, v, v])
 
 
-def is_image(filename):
-    return filename.lower().endswith(('.png', '.jpg', '.jpeg', '.bmp', '.tiff'))
+def dashed_rectangle(img, pt1, pt2, color, thickness=1, dash_length=10):
+    # An open two-point polyline is drawn exactly as cv2.line, so all the dashes go in a single call
+    segments, _ = dashed_segments(pt1[0], pt1[1], pt2[0], pt2[1], dash_length)
+    cv2.polylines(img, list(segments), False, color, thickness)
 
 
 @dataclasses.dataclass
@@ -39,6 +63,11 @@ class Config:
     ADD_LABEL: bool = True
     ALWAYS_DRAW_BBOX: bool = True
     FPS: int = 20
+    MAX_PIXELS: int = 1000000
+    PREFETCH: int = 8
+    WORKERS: int = 4
+    CACHE_MB: int = 512
+    HUD: bool = False
 
 
 class Key(enum.Enum):
@@ -88,16 +117,149 @@ def reshape(img, threshold):
     return (img, scale)
 
 
-def rotate_point(p, shape):
-    if not isinstance(p[0], float):
-        p = p[0]
-    return shape[0] - p[1], shape[1] - p[0]
-
-
-def wait_key(cnt, sleep, rotate):
+def load_frame(images_folder, img_file, max_pixels, rotate, timer=None):
+    t0 = time.perf_counter()
+    img = shards.imread(images_folder, img_file)
+    t1 = time.perf_counter()
+    if rotate:
+        img = cv2.rotate(img, cv2.ROTATE_180)
+    frame = reshape(img, max_pixels)
+    if timer is not None:
+        timer.add("decode", t1 - t0)
+        timer.add("resize", time.perf_counter() - t1)
+    return frame
+
+
+class FrameTimer:
+    # Per-frame duration of each stage, for the live HUD and the summary written on exit
+    def __init__(self):
+        self.samples = {stage: [] for stage in TIMING_STAGES}
+        self.ticks = []
+        self.lock = threading.Lock()
+
+    def add(self, stage, seconds):
+        with self.lock:
+            self.samples[stage].append(seconds)
+
+    @contextlib.contextmanager
+    def measure(self, stage):
+        t0 = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(stage, time.perf_counter() - t0)
+
+    def tick(self):
+        self.ticks.append(time.perf_counter())
+
+    def recent(self, stage, n=30):
+        with self.lock:
+            samples = self.samples[stage][-n:]
+        return sum(samples) / len(samples) if samples else 0.0
+
+    def fps(self, n=30):
+        ticks = self.ticks[-n:]
+        return (len(ticks) - 1) / (ticks[-1] - ticks[0]) if len(ticks) > 1 and ticks[-1] > ticks[0] else 0.0
+
+    def summary(self):
+        stages = dict(self.samples, frame=list(numpy.diff(self.ticks)))
+        summary = {"frames": len(self.ticks), "stages": {}}
+        for stage, samples in stages.items():
+            ms = numpy.array(samples, dtype=float) * 1e3
+            summary["stages"][stage] = {"count": len(ms), "mean_ms": float(ms.mean()) if len(ms) else 0.0, "p50_ms": float(numpy.percentile(ms, 50)) if len(ms) else 0.0, "p95_ms": float(numpy.percentile(ms, 95)) if len(ms) else 0.0}
+        summary["fps_p50"] = 1e3 / summary["stages"]["frame"]["p50_ms"] if summary["stages"]["frame"]["p50_ms"] > 0 else 0.0
+        return summary
+
+
+def print_timing(summary):
+    header = f"{'stage':<10}{'count':>8}{'mean (ms)':>12}{'p50 (ms)':>12}{'p95 (ms)':>12}"
+    print(header)
+    print("-" * len(header))
+    for stage, m in summary["stages"].items():
+        print(f"{stage:<10}{m['count']:>8}{m['mean_ms']:>12.2f}{m['p50_ms']:>12.2f}{m['p95_ms']:>12.2f}")
+    print(f"Achieved FPS (p50): {summary['fps_p50']:.1f}")
+
+
+def draw_timing(img, timer):
+    text = f"{timer.fps():.1f}/{Config.FPS} FPS | " + " ".join(f"{stage} {timer.recent(stage) * 1e3:.1f}" for stage in TIMING_STAGES if stage != "wait") + " ms"
+    cv2.putText(img, text, (10, 25), cv2.FONT_HERSHEY_SIMPLEX, 0.5, (0, 0, 0), 3)
+    cv2.putText(img, text, (10, 25), cv2.FONT_HERSHEY_SIMPLEX, 0.5, (255, 255, 255), 1)
+    return img
+
+
+class FrameCache:
+    # Size-bounded LRU cache of decoded and resized frames
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.frames = collections.OrderedDict()
+        self.size = 0
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            if key not in self.frames:
+                return None
+            self.frames.move_to_end(key)
+            return self.frames[key]
+
+    def put(self, key, frame):
+        with self.lock:
+            if key in self.frames:
+                return
+            self.frames[key] = frame
+            self.size += frame[0].nbytes
+            while self.size > self.max_bytes and len(self.frames) > 1:
+                _, (img, _) = self.frames.popitem(last=False)
+                self.size -= img.nbytes
+
+
+class FrameLoader:
+    # Decodes and resizes frames in a worker pool ahead of the playback direction
+    def __init__(self, images_folder, workers, cache_bytes, timer=None):
+        self.images_folder = images_folder
+        self.timer = timer
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=workers)
+        self.cache = FrameCache(cache_bytes)
+        self.pending = {}
+
+    def load(self, key):
+        frame = load_frame(self.images_folder, *key, timer=self.timer)
+        self.cache.put(key, frame)
+        return frame
+
+    def submit(self, key):
+        if key not in self.pending and self.cache.get(key) is None:
+            self.pending[key] = self.executor.submit(self.load, key)
+
+    def get(self, img_file, max_pixels, rotate):
+        key = (img_file, max_pixels, rotate)
+        frame = self.cache.get(key)
+        if frame is None:
+            self.submit(key)
+            frame = self.pending[key].result()
+        self.pending.pop(key, None)
+        return frame
+
+    def prefetch(self, img_files, max_pixels, rotate):
+        keys = [(img_file, max_pixels, rotate) for img_file in img_files]
+        # Frames that are no longer ahead of the playback are dropped if their decoding has not started
+        for key in set(self.pending) - set(keys):
+            if self.pending[key].done() or self.pending[key].cancel():
+                del self.pending[key]
+        for key in keys:
+            self.submit(key)
+
+    def close(self):
+        for future in self.pending.values():
+            future.cancel()
+        self.executor.shutdown()
+
+
+def wait_key(cnt, sleep, rotate, elapsed=0.0):
+    # The time already spent on the frame is subtracted from the wait, so the requested rate is met when possible
     c = 0
     while not Key.has_value(c):
-        c = cv2.waitKey(int((1 / Config.FPS) * 1e3) * (not sleep))
+        c = cv2.waitKey(0 if sleep else max(1, int((1 / Config.FPS - elapsed) * 1e3)))
         if c == -1:
             c = Key.NEXT.value
 
@@ -118,83 +280,200 @@ def callback(x):
     Config.FPS = x
 
 
-def cocoviz(json_file, images_folder, skip_non_annotated):
-    with open(json_file, 'r') as f:
-        coco = json.load(f)
-
-    img_data = coco['images']
-    ann_data = coco['annotations']
+def load_coco(json_file):
+    # Annotations are spilled to disk grouped by image, so only the annotations of the displayed frame are held in memory
+    coco = {"images": [], "categories": []}
+    ann_data = cocostream.AnnotationStore("image_id")
+    for key, value in cocostream.iter_document(json_file):
+        if key == "annotations":
+            for ann in value:
+                ann_data.add(ann)
+        elif key in coco:
+            coco[key] = list(value)
+    return coco, ann_data
+
+
+def build_frames(coco, images_folder, skip_non_annotated):
+    # Each frame is resolved to its image once, so stepping a frame only costs its own annotations
+    if skip_non_annotated:
+        return [(img['file_name'], img) for img in coco['images']]
+    image_by_file = {}
+    for img in coco['images']:
+        image_by_file.setdefault(img['file_name'], img)
+    return [(img_file, image_by_file.get(img_file)) for img_file in shards.list_images(images_folder, duplicates=True)]
+
+
+def draw_annotations(img, anns, categories, color_list, scale, rotate):
+    if not anns:
+        return img
+
+    # All the boxes and points of the frame are scaled and rotated at once
+    x, y, w, h = (scale * numpy.array([ann['bbox'] for ann in anns], dtype=float)).T
+    if rotate:
+        x, y = img.shape[0] - y - w, img.shape[1] - x - h
+    x1, y1, x2, y2 = x.astype(int), y.astype(int), (x + w).astype(int), (y + h).astype(int)
+
+    segmented = [i for i, ann in enumerate(anns) if ('segmentation' in ann) and ann['segmentation']]
+    polygons = {}
+    if segmented:
+        flat = [numpy.array(anns[i]['segmentation']).ravel() for i in segmented]
+        points = (scale * numpy.concatenate(flat)).astype(numpy.int32).reshape(-1, 2)
+        if rotate:
+            points = numpy.stack([img.shape[0] - points[:, 1], img.shape[1] - points[:, 0]], axis=1).astype(numpy.int32)
+        polygons = dict(zip(segmented, numpy.split(points, numpy.cumsum([len(f) // 2 for f in flat])[:-1])))
+
+    # Shapes sharing category, thickness and closedness are drawn with a single polylines call; cv2.rectangle is a closed polyline over the same vertices
+    categories_id = numpy.array([ann['category_id'] for ann in anns])
+    rectangles = numpy.stack([x1, y1, x2, y1, x2, y2, x1, y2], axis=1).reshape(-1, 4, 2).astype(numpy.int32)
+    batches = {}
+    dashed = []
+    for i, ann in enumerate(anns):
+        if i in polygons:
+            batches.setdefault((ann['category_id'], 3, True), []).append(polygons[i])
+            if Config.ALWAYS_DRAW_BBOX:
+                batches.setdefault((ann['category_id'], 1, True), []).append(rectangles[i])
+        elif 'is_interpolated' in ann and ann['is_interpolated']:
+            dashed.append(i)
+        else:
+            batches.setdefault((ann['category_id'], 3, True), []).append(rectangles[i])
+    if dashed:
+        segments, owners = dashed_segments(x1[dashed], y1[dashed], x2[dashed], y2[dashed])
+        owners = categories_id[dashed][owners]
+        for category_id in numpy.unique(owners):
+            batches.setdefault((category_id, 3, False), []).extend(segments[owners == category_id])
+    for (category_id, thickness, closed), shapes in batches.items():
+        cv2.polylines(img, shapes, closed, color_list[category_id], thickness)
+
+    if Config.ADD_LABEL:
+        for i, ann in enumerate(anns):
+            if 'track_id' in ann:
+                label = f"{categories[ann['category_id']]['name'].upper()} ({ann['category_id']})[{ann['track_id']}]"
+            else:
+                label = f"{categories[ann['category_id']]['name'].upper()} ({ann['category_id']})"
+            position = (int(x[i]), int(y[i] + h[i] + 30)) if y[i] < 20 else (int(x[i]), int(y[i] - 10))
+            cv2.putText(img, label, position, cv2.FONT_HERSHEY_SIMPLEX, 0.75, color_list[ann['category_id']], 2)
+    return img
+
+
+@functools.lru_cache(maxsize=None)
+def help_panel(sleep):
+    # The help text is rendered once as a coverage mask over the panel, and only blended into each frame
+    panel = numpy.zeros((HELP_PANEL[1] - HELP_PANEL[0], HELP_PANEL[3] - HELP_PANEL[2]), dtype=numpy.uint8)
+    lines = ["Press D for next image", "Press A for previous image", "Press R to rotate the image", f"Press SPACE to {'play' if sleep else 'pause'} sequence", "Press ESC to exit"]
+    for i, line in enumerate(lines):
+        cv2.putText(panel, line, (10 - HELP_PANEL[2], -130 - HELP_PANEL[0] + 25 * i), cv2.FONT_HERSHEY_SIMPLEX, 0.5, 255, 1)
+    mask = panel > 0
+    return mask, panel[mask].astype(numpy.uint16)[:, None]
+
+
+def draw_help(img, sleep):
+    region = img[img.shape[0] + HELP_PANEL[0]:img.shape[0] + HELP_PANEL[1], HELP_PANEL[2]:HELP_PANEL[3]]
+    region[...] = cv2.addWeighted(region, 0.5, region, 0, 1.0)
+    mask, coverage = help_panel(sleep)
+    text = region[mask].astype(numpy.uint16)
+    region[mask] = text + ((255 - text) * coverage + 127) // 255
+    return img
+
+
+class VideoWriter:
+    def __init__(self, path, fps):
+        self.path = path
+        self.fps = fps
+        self.writer = None
+        self.size = None
+
+    def write(self, img):
+        if self.writer is None:
+            self.size = (img.shape[1], img.shape[0])
+            self.writer = cv2.VideoWriter(self.path, cv2.VideoWriter_fourcc(*"mp4v"), self.fps, self.size)
+            if not self.writer.isOpened():
+                raise Exception(f"{self.path} could not be opened for writing.")
+        if (img.shape[1], img.shape[0]) != self.size:
+            img = cv2.resize(img, self.size)
+        self.writer.write(img)
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.release()
+
+
+def render_frame(images_folder, img_file, anns, categories, color_list, max_pixels, rotate, output=None):
+    img, scale = load_frame(images_folder, img_file, max_pixels, rotate)
+    img = draw_annotations(img, anns, categories, color_list, scale, rotate)
+    if output is not None:
+        cv2.imwrite(output, img)
+        return None
+    return img
+
+
+def export(json_file, images_folder, skip_non_annotated, output, rotate=False, fps=Config.FPS, jobs=None):
+    coco, ann_data = load_coco(json_file)
     color_list = generate_colors(len(coco['categories']), "RAINBOW")
+    frames = build_frames(coco, images_folder, skip_non_annotated)
+    video = output.lower().endswith(VIDEO_EXTENSIONS)
+    os.makedirs(os.path.dirname(os.path.abspath(output)) if video else output, exist_ok=True)
+
+    writer = VideoWriter(output, fps) if video else None
+    with concurrent.futures.ProcessPoolExecutor(max_workers=jobs) as executor, tqdm.tqdm(total=len(frames), desc="Rendering frames", unit="frame", colour="yellow") as progress:
+        # Frames are rendered in parallel but collected in order, with a bounded number in flight
+        pending = collections.deque()
+        for i, (img_file, image) in enumerate(frames):
+            anns = ann_data.get(image['id']) if image is not None else []
+            pending.append(executor.submit(render_frame, images_folder, img_file, anns, coco['categories'], color_list, Config.MAX_PIXELS, rotate, None if video else os.path.join(output, f"{i:06d}.png")))
+            while pending and (len(pending) > 2 * (jobs or os.cpu_count()) or i == len(frames) - 1):
+                img = pending.popleft().result()
+                if writer is not None:
+                    writer.write(img)
+                progress.update(1)
+    if writer is not None:
+        writer.close()
+    ann_data.close()
+
+
+def cocoviz(json_file, images_folder, skip_non_annotated, rotate=False, timing_file=None):
+    coco, ann_data = load_coco(json_file)
+    color_list = generate_colors(len(coco['categories']), "RAINBOW")
+    frames = build_frames(coco, images_folder, skip_non_annotated)
 
-    if not skip_non_annotated:
-        filenames = [x for x in os.listdir(images_folder) if is_image(x)]
-        annotated_filenames = [x['file_name'] for x in img_data]
-        filenames.sort()
-        annotated_filenames.sort()
-        has_annotations = [x in annotated_filenames for x in filenames]
-        krange = len(filenames)
-    else:
-        krange = len(img_data)
-
-    k = Counter(0, krange - 1)
+    timer = FrameTimer()
+    loader = FrameLoader(images_folder, Config.WORKERS, Config.CACHE_MB * 1024 * 1024, timer)
+    k = Counter(0, len(frames) - 1)
+    direction = 1
     sleep = True
-    rotate = False
     cv2.namedWindow("COCO VISUALIZER", cv2.WINDOW_AUTOSIZE)
-    cv2.createTrackbar("FPS", "COCO VISUALIZER", 20, 800, callback)
+    cv2.createTrackbar("FPS", "COCO VISUALIZER", Config.FPS, 800, callback)
     cv2.setTrackbarMin("FPS", "COCO VISUALIZER", 1)
 
     while True:
-        img_file = img_data[k]['file_name'] if skip_non_annotated else filenames[k]
-        img = cv2.imread(images_folder + img_file)
-        cv2.setWindowTitle("COCO VISUALIZER", f"COCO VISUALIZER - {img_file}")
-        if rotate:
-            img = cv2.rotate(img, cv2.ROTATE_180)
-        img, scale = reshape(img, 1e6)
-        for ann in ann_data:
-            if skip_non_annotated:
-                check = ann['image_id'] == img_data[k]['id']
-            else:
-                check = has_annotations[k] and ann['image_id'] == img_data[annotated_filenames.index(filenames[k])]['id']
-            if check:
-                # Label
-                x, y, w, h = [scale * x for x in ann['bbox']]
-                if 'track_id' in ann:
-                    label = f"{coco['categories'][ann['category_id']]['name'].upper()} ({ann['category_id']})[{ann['track_id']}]"
-                else:
-                    label = f"{coco['categories'][ann['category_id']]['name'].upper()} ({ann['category_id']})"
-
-                if rotate:
-                    x, y = map(lambda a, b: a - b, rotate_point([x, y], img.shape), (w, h))
-
-                if y < 20 and Config.ADD_LABEL:
-                    cv2.putText(img, label, (int(x), int(y + h + 30)), cv2.FONT_HERSHEY_SIMPLEX, 0.75, color_list[ann['category_id']], 2)
-                elif Config.ADD_LABEL:
-                    cv2.putText(img, label, (int(x), int(y - 10)), cv2.FONT_HERSHEY_SIMPLEX, 0.75, color_list[ann['category_id']], 2)
-
-                if ('segmentation' in ann) and ann['segmentation']:
-                    # Segmentation
-                    points = (scale * numpy.array(ann['segmentation'])).astype(numpy.int32).reshape(-1, 1, 2)
-                    img = cv2.polylines(img, [numpy.array([rotate_point(x, img.shape) for x in points]) if rotate else points], True, color_list[ann['category_id']], 3)
-                    if Config.ALWAYS_DRAW_BBOX:
-                        cv2.rectangle(img, (int(x), int(y)), (int(x + w), int(y + h)), color_list[ann['category_id']], 1)
-                else:
-                    # Bounding box
-                    if 'is_interpolated' in ann and ann['is_interpolated']:
-                        dashed_rectangle(img, (int(x), int(y)), (int(x + w), int(y + h)), color_list[ann['category_id']], 3)
-                    else:
-                        cv2.rectangle(img, (int(x), int(y)), (int(x + w), int(y + h)), color_list[ann['category_id']], 3)
-
-        sub_img = img[img.shape[0] - 150:img.shape[0] - 20, 5:280]
-        img[img.shape[0] - 150:img.shape[0] - 20, 5:280] = cv2.addWeighted(sub_img, 0.5, numpy.zeros(sub_img.shape, dtype=numpy.uint8), 0.5, 1.0)
-        cv2.putText(img, "Press A for previous image", (10, img.shape[0] - 105), cv2.FONT_HERSHEY_SIMPLEX, 0.5, (255, 255, 255), 1)
-        cv2.putText(img, "Press D for next image", (10, img.shape[0] - 130), cv2.FONT_HERSHEY_SIMPLEX, 0.5, (255, 255, 255), 1)
-        cv2.putText(img, "Press R to rotate the image", (10, img.shape[0] - 80), cv2.FONT_HERSHEY_SIMPLEX, 0.5, (255, 255, 255), 1)
-        cv2.putText(img, f"Press SPACE to {'play' if sleep else 'pause'} sequence", (10, img.shape[0] - 55), cv2.FONT_HERSHEY_SIMPLEX, 0.5, (255, 255, 255), 1)
-        cv2.putText(img, "Press ESC to exit", (10, img.shape[0] - 30), cv2.FONT_HERSHEY_SIMPLEX, 0.5, (255, 255, 255), 1)
-        cv2.imshow("COCO VISUALIZER", img)
-        sleep, rotate, exit = wait_key(k, sleep, rotate)
+        t0 = time.perf_counter()
+        img_file, image = frames[k]
+        with timer.measure("load"):
+            img, scale = loader.get(img_file, Config.MAX_PIXELS, rotate)
+            img = img.copy()  # The cached frame must stay clean
+        loader.prefetch([frames[(k.cnt + direction * i) % len(frames)][0] for i in range(1, Config.PREFETCH + 1)], Config.MAX_PIXELS, rotate)
+        with timer.measure("draw"):
+            img = draw_annotations(img, ann_data.get(image['id']) if image is not None else [], coco['categories'], color_list, scale, rotate)
+            img = draw_help(img, sleep)
+            if Config.HUD:
+                img = draw_timing(img, timer)
+        with timer.measure("display"):
+            cv2.setWindowTitle("COCO VISUALIZER", f"COCO VISUALIZER - {img_file}")
+            cv2.imshow("COCO VISUALIZER", img)
+        previous = k.cnt
+        with timer.measure("wait"):
+            sleep, rotate, exit = wait_key(k, sleep, rotate, time.perf_counter() - t0)
+        timer.tick()
         if exit:
+            loader.close()
+            ann_data.close()
+            summary = timer.summary()
+            print_timing(summary)
+            if timing_file is not None:
+                with open(timing_file, 'w') as f:
+                    json.dump(summary, f, indent=2)
             return
+        if k.cnt != previous:
+            direction = 1 if k.cnt == (previous + 1) % len(frames) else -1
 
 
 def main():
@@ -202,6 +481,14 @@ def main():
     parser.add_argument("json_file", help="Path to the JSON file.")
     parser.add_argument("images_folder", nargs="?", default=None, help="Optional path to the folder containing the images. If not provided, images path is obtained from the json path")
     parser.add_argument("--skip-non-annotated", "-s", action="store_true", help="Do not display non-annotated images.")
+    parser.add_argument("--prefetch", type=int, default=Config.PREFETCH, help=f"Number of frames decoded ahead of the playback direction (default: {Config.PREFETCH}).")
+    parser.add_argument("--workers", "-j", type=int, default=None, help=f"Number of workers decoding frames: threads in the viewer (default: {Config.WORKERS}) or processes in export mode (default: number of CPUs).")
+    parser.add_argument("--export", "-e", default=None, help="Render every frame without a display and write them to a video file (.mp4, .avi, .mkv) or to a folder of images.")
+    parser.add_argument("--rotate", "-r", action="store_true", help="Rotate the images 180 degrees.")
+    parser.add_argument("--fps", type=int, default=Config.FPS, help=f"Frame rate of the exported video and initial playback rate (default: {Config.FPS}).")
+    parser.add_argument("--cache-size", type=int, default=Config.CACHE_MB, help=f"Maximum size of the cache of decoded frames, in MB (default: {Config.CACHE_MB}).")
+    parser.add_argument("--hud", action="store_true", help="Show the achieved FPS and the time of each stage on the frames.")
+    parser.add_argument("--timing", "-t", default=None, help="Write the frame-timing summary (p50/p95 per stage) to this JSON file on exit.")
     args = parser.parse_args()
 
     if not os.path.isfile(args.json_file):
@@ -218,9 +505,27 @@ def main():
     if not os.path.isdir(args.images_folder):
         raise Exception(f"{args.images_folder} is not a valid directory.")
 
+    if args.workers is not None and args.workers < 1:
+        raise Exception(f"{args.workers} is not a valid number of workers.")
+
+    if args.fps < 1:
+        raise Exception(f"{args.fps} is not a valid frame rate.")
+
+    Config.FPS = args.fps
+    Config.PREFETCH = args.prefetch
+    Config.CACHE_MB = args.cache_size
+    Config.HUD = args.hud
+
     print(f"JSON file: {args.json_file}")
     print(f"Images folder: {args.images_folder}")
-    cocoviz(args.json_file, args.images_folder, args.skip_non_annotated)
+    if args.export is not None:
+        print(f"Output: {args.export}")
+        export(args.json_file, args.images_folder, args.skip_non_annotated, args.export, args.rotate, args.fps, args.workers)
+        return
+
+    if args.workers is not None:
+        Config.WORKERS = args.workers
+    cocoviz(args.json_file, args.images_folder, args.skip_non_annotated, args.rotate, args.timing)
 
     cv2.destroyAllWindows()
 
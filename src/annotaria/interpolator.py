@@ -10,30 +10,33 @@ The above copyright notice and this permission notice shall be included in all c
 THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
 """
 
-from copy import deepcopy
+from annotaria import __version__, cocostream, shards
 from PIL import Image
-from scipy.interpolate import CubicSpline
+from scipy.interpolate import CubicSpline, PPoly
 import argparse
+import bisect
+import collections
+import concurrent.futures
+import contextlib
+import hashlib
 import io
 import json
 import numpy as np
 import os
 import tqdm
+import types
 import zipfile
 
-
-def is_image(filename):
-    return filename.lower().endswith(('.png', '.jpg', '.jpeg', '.bmp', '.tiff'))
+SIZES_FILE = ".interpolator.sizes"
 
 
 def generate_indices(vector, n):
-    ret = [float(vector[0])]
-    for i in range(len(vector) - 1):
-        start = vector[i]
-        end = vector[i + 1]
-        step = (end - start) / (n[i] + 1)
-        ret.extend(start + step * j for j in range(1, n[i] + 2))
-    return ret
+    # Same values as start + step * j for j in 1..n[i] + 1 over each segment, computed for all segments at once
+    counts = np.asarray(n, dtype=np.int64) + 1
+    start = np.repeat(np.asarray(vector[:-1], dtype=float), counts)
+    step = np.repeat((np.asarray(vector[1:], dtype=float) - np.asarray(vector[:-1], dtype=float)) / counts, counts)
+    j = np.arange(1, counts.sum() + 1) - np.repeat(np.cumsum(counts) - counts, counts)
+    return [float(vector[0])] + (start + step * j).tolist()
 
 
 def mode_interpolation(vector, n):
@@ -42,67 +45,141 @@ def mode_interpolation(vector, n):
 
 
 def spline_interpolation(x, y, xs):
-    cs = CubicSpline(x, y)
-    return cs(xs)
+    y = np.asarray(y, dtype=float)
+    if y.ndim == 1:
+        return CubicSpline(x, y)(xs)
+    # Each column is fitted on its own, since the multi-column LAPACK solve may round differently in the last bit,
+    # and the pieces of all columns are stacked into a single polynomial evaluated at every query point in one call
+    splines = [CubicSpline(x, y[:, i]) for i in range(y.shape[1])]
+    return PPoly(np.stack([cs.c for cs in splines], axis=-1), splines[0].x)(xs)
+
+
+def segment_frames(files, seq):
+    # files is sorted, so the frames strictly between each pair of keyframes, and those within any pair, are found by bisection
+    lo = [bisect.bisect_left(files, x) for x in seq]
+    hi = [bisect.bisect_right(files, x) for x in seq]
+    n = [max(0, lo[i + 1] - hi[i]) for i in range(len(seq) - 1)]
+    selected = []
+    end = 0
+    for start, stop in sorted((lo[i], hi[i + 1]) for i in range(len(seq) - 1)):
+        selected.extend(files[max(start, end):stop])
+        end = max(end, stop)
+    return n, selected
+
+
+class ImageSizes:
+    # Sizes are read from the image headers once per frame; with persist, they are also kept in a sidecar file validated by the file stats
+    def __init__(self, folder, persist=False):
+        self.folder = folder
+        self.sizes = {}
+        self.stored = {record["name"]: record for record in shards.read_records(os.path.join(folder, SIZES_FILE))} if persist else {}
+        self.file = open(os.path.join(folder, SIZES_FILE), 'a', buffering=1) if persist else None
+
+    def stat(self, name):
+        name = shards.get_duplicates(os.path.abspath(self.folder)).get(name, name)
+        if shards.is_sharded(self.folder):
+            record = shards.get_reader(os.path.abspath(self.folder)).index[name]
+            return [record["shard"], record["offset"], record["size"]]
+        st = os.stat(os.path.join(self.folder, name))
+        return [st.st_mtime_ns, st.st_size]
+
+    def get(self, name):
+        if name not in self.sizes:
+            key = self.stat(name) if self.file else None
+            record = self.stored.get(name)
+            if record is not None and record["key"] == key:
+                self.sizes[name] = (record["width"], record["height"])
+            else:
+                with Image.open(shards.open_image(self.folder, name)) as img:
+                    self.sizes[name] = img.size
+                if self.file:
+                    self.file.write(json.dumps({"name": name, "key": key, "width": self.sizes[name][0], "height": self.sizes[name][1]}) + "\n")
+        return self.sizes[name]
+
+    def close(self):
+        if self.file:
+            self.file.close()
+
+
+def track_fingerprint(data, n):
+    # The interpolated annotations of a track only depend on its keyframes and on the number of frames of each segment
+    return hashlib.sha256(json.dumps([data, n]).encode('utf-8')).hexdigest()
 
 
-def run_interp(data, n, debug=None):
+def read_index(path, output_file):
+    # The index is only valid for the output file it was written with, by the same version
+    fingerprints = {}
+    if os.path.isfile(path) and os.path.isfile(output_file):
+        with open(path, 'r') as f:
+            try:
+                records = [json.loads(line) for line in f]
+            except json.JSONDecodeError:
+                return fingerprints  # Truncated file left by an interrupted run
+        st = os.stat(output_file)
+        if records and records[0] == {"version": __version__, "output": [st.st_mtime_ns, st.st_size]}:
+            fingerprints = {record["track_id"]: record["fingerprint"] for record in records[1:]}
+    return fingerprints
+
+
+def run_interp(data, n):
     orig_id = [item['image_id'] for item in data]
     image_id = generate_indices(orig_id, n)
     category_id, mode = mode_interpolation([item['category_id'] for item in data], n)
-    bbox_x = spline_interpolation([item['image_id'] for item in data], [item['bbox'][0] for item in data], image_id)
-    bbox_y = spline_interpolation([item['image_id'] for item in data], [item['bbox'][1] for item in data], image_id)
-    bbox_w = spline_interpolation([item['image_id'] for item in data], [item['bbox'][2] for item in data], image_id)
-    bbox_h = spline_interpolation([item['image_id'] for item in data], [item['bbox'][3] for item in data], image_id)
+    # The four box coordinates are interpolated together over the stacked (n, 4) boxes
+    bbox = spline_interpolation(orig_id, [item['bbox'] for item in data], image_id)
+    rounded = np.round(bbox, 12).tolist()
+    area = (bbox[:, 2] * bbox[:, 3]).astype(np.int64).tolist()
+    keyframes = set(orig_id)
 
     output = []
     for i in range(len(image_id)):
-        d = deepcopy(data[0])
+        # Every nested field that differs between frames is replaced, so a shallow copy serializes as the deepcopy did
+        d = dict(data[0])
         d["image_id"] = image_id[i]
-        d["bbox"] = [round(bbox_x[i], 12), round(bbox_y[i], 12), round(bbox_w[i], 12), round(bbox_h[i], 12)]
+        d["bbox"] = rounded[i]
         d["segmentation"] = []
         d["category_id"] = category_id[i]
-        d["area"] = int(bbox_w[i] * bbox_h[i])
-        d["is_interpolated"] = image_id[i] not in orig_id
+        d["area"] = area[i]
+        d["is_interpolated"] = image_id[i] not in keyframes
         output.append(d)
 
-    if debug is not None:
-        import warnings
-        warnings.filterwarnings("ignore")
-        import matplotlib.pyplot as plt
-        warnings.filterwarnings("default")
-        plt.figure(figsize=(10, 6))
-        fi = [item['image_id'] for item in data]
-        bbx = [item['bbox'][0] for item in data]
-        bby = [item['bbox'][1] for item in data]
-        bbw = [item['bbox'][2] for item in data]
-        bbh = [item['bbox'][3] for item in data]
-        plt.plot(fi, bbx, 'o', label='Bounding Box X', color='blue', markersize=2.5)
-        plt.plot(fi, bby, 'o', label='Bounding Box Y', color='green', markersize=2.5)
-        plt.plot(fi, bbw, 'o', label='Bounding Box W', color='red', markersize=2.5)
-        plt.plot(fi, bbh, 'o', label='Bounding Box H', color='purple', markersize=2.5)
-        plt.plot(image_id, bbox_x, label='Interpolated Bounding Box X0', color='blue')
-        plt.plot(image_id, bbox_y, label='Interpolated Bounding Box Y0', color='green')
-        plt.plot(image_id, bbox_w, label='Interpolated Bounding Box X1', color='red')
-        plt.plot(image_id, bbox_h, label='Interpolated Bounding Box Y1', color='purple')
-        plt.title(f"Interpolated Bounding Box Coordinates for track ID {data[0]['track_id']}")
-        plt.xlabel("Frame Index")
-        plt.ylabel("Bounding Box Coordinates")
-        plt.legend()
-        plt.grid(True)
-
-        # Save plot to in-memory buffer and write to zip
-        buffer = io.BytesIO()
-        plt.savefig(buffer, format='png')
-        buffer.seek(0)
-        with zipfile.ZipFile(debug, 'a') as zf:
-            zf.writestr(f"track{data[0]['track_id']}_plot.png", buffer.read())
-        buffer.close()
-        plt.close()
-
     return output
 
 
+def plot_interp(data, n):
+    import warnings
+    warnings.filterwarnings("ignore")
+    import matplotlib.pyplot as plt
+    warnings.filterwarnings("default")
+    fi = [item['image_id'] for item in data]
+    image_id = generate_indices(fi, n)
+    bbox_x, bbox_y, bbox_w, bbox_h = spline_interpolation(fi, [item['bbox'] for item in data], image_id).T
+    plt.figure(figsize=(10, 6))
+    bbx = [item['bbox'][0] for item in data]
+    bby = [item['bbox'][1] for item in data]
+    bbw = [item['bbox'][2] for item in data]
+    bbh = [item['bbox'][3] for item in data]
+    plt.plot(fi, bbx, 'o', label='Bounding Box X', color='blue', markersize=2.5)
+    plt.plot(fi, bby, 'o', label='Bounding Box Y', color='green', markersize=2.5)
+    plt.plot(fi, bbw, 'o', label='Bounding Box W', color='red', markersize=2.5)
+    plt.plot(fi, bbh, 'o', label='Bounding Box H', color='purple', markersize=2.5)
+    plt.plot(image_id, bbox_x, label='Interpolated Bounding Box X0', color='blue')
+    plt.plot(image_id, bbox_y, label='Interpolated Bounding Box Y0', color='green')
+    plt.plot(image_id, bbox_w, label='Interpolated Bounding Box X1', color='red')
+    plt.plot(image_id, bbox_h, label='Interpolated Bounding Box Y1', color='purple')
+    plt.title(f"Interpolated Bounding Box Coordinates for track ID {data[0]['track_id']}")
+    plt.xlabel("Frame Index")
+    plt.ylabel("Bounding Box Coordinates")
+    plt.legend()
+    plt.grid(True)
+
+    # Save plot to in-memory buffer, written to the zip by the main process
+    buffer = io.BytesIO()
+    plt.savefig(buffer, format='png')
+    plt.close()
+    return f"track{data[0]['track_id']}_plot.png", buffer.getvalue()
+
+
 def main():
     parser = argparse.ArgumentParser(description="COCO interpolator.")
     parser.add_argument("json_file", help="Path to the JSON file.")
@@ -110,54 +187,111 @@ def main():
     group.add_argument("-n", "--number", type=int, help="Interpolation factor")
     group.add_argument("-a", "--auto", action="store_true", help="Automatically select interpolation factor to fit non-annotated images.")
     parser.add_argument("-d", "--debug", action="store_true", help="Enable debug mode.")
+    parser.add_argument("-j", "--jobs", type=int, default=os.cpu_count(), help="Number of worker processes interpolating tracks and rendering debug plots (default: number of CPUs).")
+    parser.add_argument("--full", action="store_true", help="Re-interpolate every track, ignoring the index of the previous run.")
+    parser.add_argument("--size-cache", action="store_true", help=f"Keep the image sizes read in auto mode in a {SIZES_FILE} file of the images folder.")
     args = parser.parse_args()
+    images_folder = os.path.abspath(args.json_file).replace(".json", "/")
     debug_zip = os.path.abspath(args.json_file).replace(".json", "-interp_debug.zip") if args.debug else None
+    output_file = os.path.abspath(args.json_file).replace('.json', '-interp.json')
+    index_file = os.path.abspath(args.json_file).replace('.json', '-interp.index')
+    if args.jobs < 1:
+        raise Exception(f"{args.jobs} is not a valid number of jobs.")
+
+    # Annotations are spilled to disk grouped by track, and the interpolated ones grouped by image, so only one track is held in memory
+    json_file = {}
+    with cocostream.AnnotationStore("track_id") as track_annotations, cocostream.AnnotationStore("image_id") as interp_annotations, cocostream.AnnotationStore("track_id") as previous_annotations:
+        # Tracks whose fingerprint did not change since the previous run are taken from its output instead of being interpolated again
+        previous = {} if args.full else read_index(index_file, output_file)
+        if previous:
+            for annotation in cocostream.iter_array(output_file, "annotations"):
+                previous_annotations.add(annotation)
+
+        for key, value in cocostream.iter_document(os.path.abspath(args.json_file)):
+            if key == "annotations":
+                for annotation in value:
+                    track_annotations.add(annotation)
+                value = []
+            json_file[key] = list(value) if isinstance(value, types.GeneratorType) else value
 
-    if debug_zip:
-        with zipfile.ZipFile(debug_zip, 'w') as zf:
-            pass  # Create an empty zip file to append debug images later
-
-    with open(os.path.abspath(args.json_file), 'r') as f:
-        json_file = json.load(f)
-        annotations = json_file.get("annotations", [])
-        track_annotations = {}
-        for annotation in annotations:
-            track_id = annotation.get("track_id")
-            if track_id not in track_annotations:
-                track_annotations[track_id] = []
-            track_annotations[track_id].append(annotation)
-
-        interp_annotations = []
         used_image_files = {}
-        for track_id, track in tqdm.tqdm(track_annotations.items(), desc="Interpolating annotations", unit="instance", colour="yellow"):
-            seq = [item['image_id'] for item in track]
-            if len(seq) < 2:
-                continue
-            if args.auto:
-                seq = [img["file_name"] for img in json_file.get("images", []) if img["id"] in seq]
-                seq_files = sorted([f for f in os.listdir(os.path.abspath(args.json_file).replace(".json", "/")) if is_image(f)])
-                n = [sum(1 for f in seq_files if seq[i] < f < seq[i + 1]) for i in range(len(seq) - 1)]
-                interp_annotations.extend(run_interp(track, n, debug_zip))
+        fingerprints = {}
+        reused = 0
+        if args.auto:
+            # The folder is listed once, and every image of the JSON file is located by id instead of scanning the list for each track
+            seq_files = shards.list_images(images_folder, duplicates=True)
+            image_sizes = ImageSizes(images_folder, args.size_cache)
+            files_by_id = {}
+            for position, img in enumerate(json_file.get("images", [])):
+                files_by_id.setdefault(img["id"], []).append((position, img["file_name"]))
 
+        def tracks():
+            for track_id in track_annotations.keys():
+                track = track_annotations.get(track_id)
+                seq = [item['image_id'] for item in track]
+                if len(seq) < 2:
+                    progress.update()
+                    continue
+                if args.auto:
+                    seq = [file_name for _, file_name in sorted(x for img_id in set(seq) for x in files_by_id.get(img_id, ()))]
+                    n, image_filename = segment_frames(seq_files, seq)
+                else:
+                    n, image_filename = [(args.number + 1) * (seq[i + 1] - seq[i]) - 1 for i in range(len(seq) - 1)], []
+                yield track_id, track, n, image_filename
+
+        def collect(pending):
+            # Results are collected in submission order, so annotation ids and zip members do not depend on the number of jobs
+            track, n, image_filename, result, plot = pending.popleft()
+            for annotation in result.result() if isinstance(result, concurrent.futures.Future) else result:
+                interp_annotations.add(annotation)
+            if plot is not None:
+                zf.writestr(*plot.result())
+            if args.auto:
                 image_id = generate_indices([item['image_id'] for item in track], n)
-                image_filename = [f for f in seq_files if any(seq[i] <= f <= seq[i + 1] for i in range(len(seq) - 1))]
                 for img_id, img_file in zip(image_id, image_filename):
-                    img_path = os.path.join(os.path.abspath(args.json_file).replace(".json", "/"), img_file)
-                    with Image.open(img_path) as img:
-                        width, height = img.size
+                    width, height = image_sizes.get(img_file)
                     used_image_files[img_id] = {"file_name": img_file, "width": width, "height": height}
-            else:
-                n = [(args.number + 1) * (seq[i + 1] - seq[i]) - 1 for i in range(len(seq) - 1)]
-                interp_annotations.extend(run_interp(track, n, debug_zip))
-
-    with open(os.path.abspath(args.json_file).replace('.json', '-interp.json'), 'w', encoding='utf-8') as f:
-        interp_annotations = sorted(interp_annotations, key=lambda x: x["image_id"])
-        for idx, annotation in enumerate(interp_annotations):
-            annotation["id"] = idx + 1
-        json_file["annotations"] = interp_annotations
+            progress.update()
+
+        # Tracks and debug plots are separate tasks of the process pool, and the debug zip is kept open for the whole run
+        with concurrent.futures.ProcessPoolExecutor(max_workers=args.jobs) as executor, zipfile.ZipFile(debug_zip, 'w') if debug_zip else contextlib.nullcontext() as zf, tqdm.tqdm(total=len(track_annotations.keys()), desc="Interpolating annotations", unit="instance", colour="yellow") as progress:
+            pending = collections.deque()
+            for track_id, track, n, image_filename in tracks():
+                if len(pending) >= 4 * args.jobs:
+                    collect(pending)
+                fingerprints[track_id] = track_fingerprint(track, n)
+                if previous.get(track_id) == fingerprints[track_id]:
+                    result = previous_annotations.get(track_id)
+                    reused += 1
+                else:
+                    result = executor.submit(run_interp, track, n)
+                pending.append((track, n, image_filename, result, executor.submit(plot_interp, track, n) if debug_zip else None))
+            while pending:
+                collect(pending)
+
+        def sorted_annotations():
+            # Images are visited in order and the annotations of each image keep their insertion order, as a stable sort by image_id would
+            idx = 0
+            for image_id in sorted(interp_annotations.keys()):
+                for annotation in interp_annotations.get(image_id):
+                    idx += 1
+                    annotation["id"] = idx
+                    yield annotation
+
         if args.auto:
+            image_sizes.close()
             json_file["images"] = [{"height": img_file["height"], "width": img_file["width"], "id": img_id, "file_name": img_file["file_name"]} for img_id, img_file in used_image_files.items()]
-        json.dump(json_file, f, ensure_ascii=False, indent=2)
+        json_file["annotations"] = sorted_annotations()
+        with open(output_file, 'w', encoding='utf-8') as f:
+            cocostream.write_document(f, json_file.items(), ensure_ascii=False)
+
+    st = os.stat(output_file)
+    with open(f"{index_file}.tmp", 'w') as f:
+        f.write(json.dumps({"version": __version__, "output": [st.st_mtime_ns, st.st_size]}) + "\n")
+        for track_id, fingerprint in fingerprints.items():
+            f.write(json.dumps({"track_id": track_id, "fingerprint": fingerprint}) + "\n")
+    os.replace(f"{index_file}.tmp", index_file)
+    print(f"Tracks: {len(fingerprints) - reused} interpolated, {reused} reused (unchanged)")
 
 
 if __name__ == "__main__":
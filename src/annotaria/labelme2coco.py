@@ -10,51 +10,199 @@ The above copyright notice and this permission notice shall be included in all c
 THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
 """
 
-from labelme2coco import get_coco_from_labelme_folder
+from pathlib import Path
+from sahi.utils.coco import CocoAnnotation
 import argparse
+import collections
+import concurrent.futures
+import itertools
 import json
+import numpy
 import os
-import sys
+import shutil
+import tempfile
+import textwrap
+
+INDEX_FILE = ".labelme2coco.index"
+CHUNK_SIZE = 16
+
+
+def list_labelme_files(folder):
+    return sorted(os.path.join(root, x) for root, _, files in os.walk(folder) for x in files if ".json" in x.lower())
+
+
+def parse_labelme_file(json_path):
+    # Same conversion as labelme2coco.get_coco_from_labelme_folder, for a single LabelMe file
+    with open(json_path, 'r', encoding='utf-8') as f:
+        data = json.load(f)
+
+    image = {"height": data["imageHeight"], "width": data["imageWidth"], "file_name": os.path.basename(str(Path(json_path).parent / data["imagePath"]))}
+    annotations = []
+    for shape in data["shapes"]:
+        points = shape["points"]
+        shape_type = shape["shape_type"]
+        if shape_type == "circle":
+            (cx, cy), (x1, y1) = points
+            r = numpy.linalg.norm(numpy.array([x1 - cx, y1 - cy]))
+            angles = numpy.linspace(0, 2 * numpy.pi, 50 * (int(r) + 1))
+            x = cx + r * numpy.cos(angles)
+            y = cy + r * numpy.sin(angles)
+            points = numpy.rint(numpy.append(x, y).reshape(-1, 2, order='F'))
+            _, index = numpy.unique(points, return_index=True, axis=0)
+            points = points[numpy.sort(index)]
+            shape_type = "polygon"
+        elif shape_type == "line":
+            (x1, y1), (x2, y2) = points
+            points = [x1, y1, x2, y2, x2 + 1e-3, y2 + 1e-3, x1 + 1e-3, y1 + 1e-3]
+            shape_type = "polygon"
+        elif shape_type == "point":
+            (x1, y1) = points[0]
+            points = [[x1, y1], [x1 + 1, y1 + 1]]
+            shape_type = "rectangle"
+
+        if shape_type == "rectangle":
+            (x1, y1), (x2, y2) = points[0], points[1]
+            coco_annotation = CocoAnnotation(bbox=[x1, y1, x2 - x1, y2 - y1], category_id=0)
+        elif shape_type == "polygon":
+            coco_annotation = CocoAnnotation(segmentation=[numpy.asarray(points).flatten().tolist()], category_id=0)
+        else:
+            raise NotImplementedError(f'shape_type={shape_type} not supported.')
+        annotations.append({"label": shape["label"], "bbox": coco_annotation.bbox, "segmentation": coco_annotation.segmentation, "area": coco_annotation.area, "group_id": shape.get("group_id")})
+
+    return image, annotations
+
+
+def parse_labelme_files(json_paths):
+    return [parse_labelme_file(json_path) for json_path in json_paths]
+
+
+def write_items(f, items):
+    # Writes a list the same way as json.dump(..., indent=2) does at the second level of the document
+    count = 0
+    for item in items:
+        f.write(("," if count else "") + "\n" + textwrap.indent(json.dumps(item, indent=2), "    "))
+        count += 1
+    f.write("\n  ]" if count else "]")
+
+
+def read_index(folder):
+    # The first line of the index records the output file it was written with
+    path = os.path.join(folder, INDEX_FILE)
+    if os.path.isfile(path):
+        with open(path, 'r') as f:
+            for line in f:
+                yield json.loads(line)
+
+
+def output_stats(output_file):
+    st = os.stat(output_file)
+    return {"output": [st.st_mtime_ns, st.st_size]}
+
+
+def index_is_valid(folder, output_file):
+    # An index is only valid for the output file it was written with, so an output left incomplete by an interrupted run is rebuilt
+    return os.path.isfile(output_file) and next(read_index(folder), None) == output_stats(output_file)
+
+
+def labelme2coco(folder, output_file, executor, full=False, jobs=1):
+    files = list_labelme_files(folder)
+    stats = {}
+    for file in files:
+        st = os.stat(file)
+        stats[os.path.relpath(file, folder)] = [st.st_mtime_ns, st.st_size]
+
+    # Only LabelMe files that were added or changed since the last run are parsed again; the others are taken from the index
+    valid = not full and index_is_valid(folder, output_file)
+    indexed = {record["path"]: [record["mtime"], record["size"]] for record in itertools.islice(read_index(folder), 1, None)} if valid else {}
+    if valid and indexed == stats:
+        return
+    changed = [file for file in files if indexed.get(os.path.relpath(file, folder)) != stats[os.path.relpath(file, folder)]]
+
+    def parse():
+        # Files are parsed in chunks of 16, with at most 4 * jobs chunks in flight, so parsed files do not pile up when writing is slower
+        pending = collections.deque()
+        for i in range(0, len(changed), CHUNK_SIZE):
+            if len(pending) >= 4 * jobs:
+                yield from pending.popleft().result()
+            pending.append(executor.submit(parse_labelme_files, changed[i:i + CHUNK_SIZE]))
+        while pending:
+            yield from pending.popleft().result()
+
+    parsed = parse()
+
+    def entries():
+        # The index is sorted like the file list, so cached entries are read in a single pass along with it
+        records = itertools.islice(read_index(folder), 1, None) if valid else iter(())
+        for file in files:
+            path = os.path.relpath(file, folder)
+            if indexed.get(path) == stats[path]:
+                record = next(x for x in records if x["path"] == path)
+                yield path, record["image"], record["annotations"]
+            else:
+                yield (path,) + next(parsed)
+
+    # Images are streamed to the output file and annotations to a temporary file appended afterwards, so memory does not grow with the folder
+    categories = {}
+    # The output is written next to its final path and replaced before the index, so an interrupted run never leaves a valid index for it
+    with open(f"{output_file}.tmp", 'w') as f, tempfile.TemporaryFile('w+', dir=os.path.dirname(os.path.abspath(output_file))) as tmp, tempfile.TemporaryFile('w+', dir=folder) as index:
+        def images():
+            annotation_id = 1
+            tmp.write('[')
+            for image_id, (path, image, annotations) in enumerate(entries(), start=1):
+                index.write(json.dumps({"path": path, "mtime": stats[path][0], "size": stats[path][1], "image_id": image_id, "annotation_ids": [annotation_id, annotation_id + len(annotations) - 1], "image": image, "annotations": annotations}) + "\n")
+                for annotation in annotations:
+                    if annotation["label"] not in categories:
+                        categories[annotation["label"]] = len(categories)
+                    tmp.write(("," if annotation_id > 1 else "") + "\n" + textwrap.indent(json.dumps({
+                        "iscrowd": 0,
+                        "image_id": image_id,
+                        "bbox": [round(coord, 12) for coord in annotation["bbox"]],
+                        "segmentation": annotation["segmentation"],
+                        "category_id": categories[annotation["label"]],
+                        "id": annotation_id,
+                        "area": annotation["area"],
+                        "track_id": annotation["group_id"],
+                    }, indent=2), "    "))
+                    annotation_id += 1
+                yield {"height": image["height"], "width": image["width"], "id": image_id, "file_name": image["file_name"]}
+            tmp.write("\n  ]" if annotation_id > 1 else "]")
+
+        f.write('{\n  "images": [')
+        write_items(f, images())
+        f.write(',\n  "annotations": ')
+        tmp.seek(0)
+        shutil.copyfileobj(tmp, f)
+        f.write(',\n  "categories": [')
+        write_items(f, ({"id": category_id, "name": name, "supercategory": name} for name, category_id in categories.items()))
+        f.write("\n}")
+        f.close()
+        os.replace(f"{output_file}.tmp", output_file)
+
+        with open(os.path.join(folder, f"{INDEX_FILE}.tmp"), 'w') as index_file:
+            index_file.write(json.dumps(output_stats(output_file)) + "\n")
+            index.seek(0)
+            shutil.copyfileobj(index, index_file)
+    os.replace(os.path.join(folder, f"{INDEX_FILE}.tmp"), os.path.join(folder, INDEX_FILE))
 
 
 def main():
     parser = argparse.ArgumentParser(description="Convert LabelMe annotations to COCO format.")
     parser.add_argument('folders', metavar='FOLDERS', type=str, nargs='+', help='Folders to process')
+    parser.add_argument('--jobs', '-j', type=int, default=os.cpu_count(), help='Number of worker processes parsing LabelMe files and of folders converted at the same time (default: number of CPUs)')
+    parser.add_argument('--full', action='store_true', help='Rebuild the COCO files from scratch, ignoring the index of previously parsed LabelMe files')
     args = parser.parse_args()
 
     for arg in args.folders:
         if not os.path.isdir(arg):
             raise Exception(f"{arg} is not a valid folder.")
 
-    for path in args.folders:
-        for folder in [x for x in os.listdir(path) if os.path.isdir(os.path.join(path, x))]:
-            with open(os.path.join(path, f"{folder}.json"), 'w') as f:
-                x = get_coco_from_labelme_folder(os.path.join(path, folder)).json
-
-                for image in x.get("images", []):
-                    file_name = image.get("file_name", "")
-                    image["file_name"] = os.path.basename(file_name)
-
-                image_id_prev = -1
-                cnt = 0
-                for annotation in x.get("annotations", []):
-                    image_id = annotation.get("image_id", "")
-                    if image_id == image_id_prev:
-                        cnt += 1
-                    else:
-                        cnt = 0
-                    image_id_prev = image_id
-                    for image in x.get("images", []):
-                        if image.get("id") == annotation.get("image_id"):
-                            filename = os.path.splitext(image.get("file_name", ""))[0]
-                            with open(os.path.join(path, folder, f"{filename}.json"), 'r') as f2:
-                                data = json.load(f2)
-                                track_id = data.get("shapes", [])[cnt]["group_id"]
-                                annotation["track_id"] = track_id
-                            break
-                    annotation["bbox"] = [round(coord, 12) for coord in annotation.get("bbox", [])]
-
-                json.dump(x, f, indent=2)
+    if args.jobs < 1:
+        raise Exception(f"{args.jobs} is not a valid number of jobs.")
+
+    folders = [(path, x) for path in args.folders for x in os.listdir(path) if os.path.isdir(os.path.join(path, x))]
+    with concurrent.futures.ProcessPoolExecutor(max_workers=args.jobs) as executor, concurrent.futures.ThreadPoolExecutor(max_workers=args.jobs) as threads:
+        for future in [threads.submit(labelme2coco, os.path.join(path, folder), os.path.join(path, f"{folder}.json"), executor, args.full, args.jobs) for path, folder in folders]:
+            future.result()
 
 
 if __name__ == '__main__':
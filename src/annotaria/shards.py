@@ -0,0 +1,152 @@
+#!/usr/bin/env python3
+"""
+Copyright (c) Raul Tapia
+Email: raultapia@us.es
+
+Permission is hereby granted, free of charge, to any person obtaining a copy of this software and associated documentation files (the "Software"), to deal in the Software without restriction, including without limitation the rights to use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of the Software, and to permit persons to whom the Software is furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+"""
+
+import cv2
+import functools
+import io
+import json
+import numpy
+import os
+import tarfile
+import threading
+
+INDEX_FILE = ".shards.index"
+DUPLICATES_FILE = ".bag2images.duplicates"
+
+
+def read_records(path):
+    # Reads a JSON lines file written line by line, which may not exist yet
+    if os.path.isfile(path):
+        with open(path, 'r') as f:
+            for line in f:
+                try:
+                    yield json.loads(line)
+                except json.JSONDecodeError:
+                    continue  # Truncated line left by an interrupted run
+
+
+def is_image(filename):
+    return filename.lower().endswith(('.png', '.jpg', '.jpeg', '.bmp', '.tiff'))
+
+
+def is_sharded(folder):
+    return os.path.isfile(os.path.join(folder, INDEX_FILE))
+
+
+class ShardWriter:
+    def __init__(self, folder, shard_size):
+        self.folder = folder
+        self.shard_size = shard_size
+        self.index = ShardReader.load_index(folder)
+        self.shard_id = 0
+        self.tar = None
+        self.index_file = open(os.path.join(folder, INDEX_FILE), 'a', buffering=1)
+
+    def __contains__(self, name):
+        return name in self.index
+
+    def write(self, name, data):
+        if self.tar is None or self.tar.fileobj.tell() >= self.shard_size:
+            self.next_shard()
+        info = tarfile.TarInfo(name)
+        info.size = len(data)
+        self.tar.addfile(info, io.BytesIO(data))
+        # Member data is padded to the tar block size and ends at the current position of the shard
+        offset = self.tar.fileobj.tell() - -(-info.size // tarfile.BLOCKSIZE) * tarfile.BLOCKSIZE
+        # The member is flushed to the OS before its index line is written, so an interrupted run never indexes a partial frame
+        self.tar.fileobj.flush()
+        record = {"name": name, "shard": os.path.basename(self.tar.name), "offset": offset, "size": info.size}
+        self.index[name] = record
+        self.index_file.write(json.dumps(record) + "\n")
+
+    def next_shard(self):
+        if self.tar is not None:
+            self.tar.close()
+        # New runs never append to existing shards, which may have been left unterminated by an interrupted run
+        while os.path.exists(os.path.join(self.folder, f"shard-{self.shard_id:05d}.tar")):
+            self.shard_id += 1
+        self.tar = tarfile.open(os.path.join(self.folder, f"shard-{self.shard_id:05d}.tar"), 'w', format=tarfile.GNU_FORMAT)
+
+    def close(self):
+        if self.tar is not None:
+            self.tar.close()
+        self.index_file.close()
+
+
+class ShardReader:
+    def __init__(self, folder):
+        self.folder = folder
+        self.index = ShardReader.load_index(folder)
+        self.files = {}
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def load_index(folder):
+        return {record["name"]: record for record in read_records(os.path.join(folder, INDEX_FILE))}
+
+    def names(self):
+        return sorted(self.index)
+
+    def read(self, name):
+        record = self.index[name]
+        with self.lock:
+            if record["shard"] not in self.files:
+                self.files[record["shard"]] = open(os.path.join(self.folder, record["shard"]), 'rb')
+            f = self.files[record["shard"]]
+            f.seek(record["offset"])
+            return f.read(record["size"])
+
+
+def load_duplicates(folder):
+    return {f"{record['timestamp']}.png": f"{record['kept']}.png" for record in read_records(os.path.join(folder, DUPLICATES_FILE))}
+
+
+@functools.lru_cache(maxsize=None)
+def get_reader(folder):
+    return ShardReader(folder)
+
+
+@functools.lru_cache(maxsize=None)
+def get_duplicates(folder):
+    return load_duplicates(folder)
+
+
+def list_images(folder, duplicates=False):
+    if is_sharded(folder):
+        names = get_reader(os.path.abspath(folder)).names()
+    else:
+        names = sorted(x for x in os.listdir(folder) if is_image(x))
+    if duplicates:
+        names = sorted(set(names).union(get_duplicates(os.path.abspath(folder))))
+    return names
+
+
+def read_image(folder, name):
+    name = get_duplicates(os.path.abspath(folder)).get(name, name)
+    if is_sharded(folder):
+        return get_reader(os.path.abspath(folder)).read(name)
+    with open(os.path.join(folder, name), 'rb') as f:
+        return f.read()
+
+
+def imread(folder, name):
+    name = get_duplicates(os.path.abspath(folder)).get(name, name)
+    if is_sharded(folder):
+        return cv2.imdecode(numpy.frombuffer(read_image(folder, name), numpy.uint8), cv2.IMREAD_COLOR)
+    return cv2.imread(os.path.join(folder, name))
+
+
+def open_image(folder, name):
+    name = get_duplicates(os.path.abspath(folder)).get(name, name)
+    if is_sharded(folder):
+        return io.BytesIO(read_image(folder, name))
+    return os.path.join(folder, name)
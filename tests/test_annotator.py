@@ -1,7 +1,14 @@
+from annotaria import cocostream
+from annotaria.autolabel import run_yolo
 from annotaria.coco2labelme import main as coco2labelme_main
-from annotaria.interpolator import main as interpolator_main
+from annotaria.interpolator import main as interpolator_main, segment_frames
 from annotaria.labelme2coco import main as labelme2coco_main
+from annotaria.shards import DUPLICATES_FILE, ShardWriter, list_images, load_duplicates, read_image
 from unittest.mock import patch
+import io
+import cv2
+import json
+import numpy
 import os
 import pytest
 import re
@@ -16,7 +23,7 @@ def clear_json_files(request):
     def clear():
         for root, dirs, files in os.walk(os.path.join(tests_dir, "eval")):
             for file in files:
-                if file.endswith(".json"):
+                if file.endswith(".json") or file.endswith(".index"):
                     os.remove(os.path.join(root, file))
 
     clear()
@@ -64,9 +71,171 @@ def test_labelme2coco(setup_labelme2coco):
         assert f1.read() == f2.read(), "The files are not exactly equal"
 
 
+def test_labelme2coco_incremental(setup_labelme2coco):
+    with patch("sys.argv", ["labelme2coco.py", os.path.join(setup_labelme2coco, "eval")]):
+        labelme2coco_main()
+
+    os.remove(os.path.join(setup_labelme2coco, "eval/images/000000011122.json"))
+    with patch("sys.argv", ["labelme2coco.py", os.path.join(setup_labelme2coco, "eval")]):
+        labelme2coco_main()
+
+    shutil.copy(os.path.join(setup_labelme2coco, "gt", "000000011122.json"), os.path.join(setup_labelme2coco, "eval", "images"))
+    with patch("sys.argv", ["labelme2coco.py", os.path.join(setup_labelme2coco, "eval")]):
+        labelme2coco_main()
+
+    # An output left incomplete by an interrupted run no longer matches the index and is rebuilt
+    with open(os.path.join(setup_labelme2coco, "eval/images.json"), "r+") as f:
+        f.truncate(15)
+    with patch("sys.argv", ["labelme2coco.py", os.path.join(setup_labelme2coco, "eval")]):
+        labelme2coco_main()
+
+    with open(os.path.join(setup_labelme2coco, "eval/images.json"), "r") as f1, open(os.path.join(setup_labelme2coco, "gt", "images.json"), "r") as f2:
+        assert f1.read() == f2.read(), "The files are not exactly equal"
+
+
 def test_interpolator(setup_interpolator):
     with patch("sys.argv", ["coco2labelme.py", os.path.join(setup_interpolator, "eval/images.json"), "-n", "3"]):
         interpolator_main()
 
     with open(os.path.join(setup_interpolator, "eval/images-interp.json"), "r") as f1, open(os.path.join(setup_interpolator, "gt", "images-interp.json"), "r") as f2:
         assert f1.read() == f2.read(), "The files are not exactly equal"
+
+
+def test_interpolator_incremental(setup_interpolator):
+    path = os.path.join(setup_interpolator, "eval/images.json")
+    for number in ["2", "3"]:
+        with patch("sys.argv", ["interpolator.py", path, "-n", number]):
+            interpolator_main()
+
+    with open(path, "r") as f:
+        coco = json.load(f)
+    coco["annotations"][0]["bbox"][0] += 1.5
+    with open(path, "w") as f:
+        json.dump(coco, f)
+    with patch("sys.argv", ["interpolator.py", path, "-n", "3"]):
+        interpolator_main()
+
+    shutil.copy(os.path.join(setup_interpolator, "gt", "images.json"), path)
+    for _ in range(2):
+        with patch("sys.argv", ["interpolator.py", path, "-n", "3"]):
+            interpolator_main()
+
+    with open(os.path.join(setup_interpolator, "eval/images-interp.json"), "r") as f1, open(os.path.join(setup_interpolator, "gt", "images-interp.json"), "r") as f2:
+        assert f1.read() == f2.read(), "The files are not exactly equal"
+
+
+def test_segment_frames():
+    files = sorted(f"{i:04d}.png" for i in range(0, 40, 2))
+    for seq in (["0002.png", "0009.png", "0030.png"], ["0010.png", "0003.png", "0020.png", "0021.png"]):
+        n = [sum(1 for f in files if seq[i] < f < seq[i + 1]) for i in range(len(seq) - 1)]
+        selected = [f for f in files if any(seq[i] <= f <= seq[i + 1] for i in range(len(seq) - 1))]
+        assert segment_frames(files, seq) == (n, selected)
+
+
+def test_shards(tmp_path):
+    images = {}
+    for file in ["000000002592", "000000011122", "000000013348"]:
+        with open(os.path.join(os.path.dirname(__file__), "eval", "images", f"{file}.jpg"), "rb") as f:
+            images[f"{file}.jpg"] = f.read()
+
+    shards = ShardWriter(str(tmp_path), 1)
+    for name, data in images.items():
+        shards.write(name, data)
+    shards.close()
+
+    assert len([x for x in os.listdir(tmp_path) if x.endswith(".tar")]) == len(images)
+    assert list_images(str(tmp_path)) == sorted(images)
+    for name, data in images.items():
+        assert read_image(str(tmp_path), name) == data
+
+
+def test_duplicates(tmp_path):
+    for name in ["1.png", "3.png"]:
+        with open(os.path.join(tmp_path, name), "wb") as f:
+            f.write(name.encode())
+    with open(os.path.join(tmp_path, DUPLICATES_FILE), "w") as f:
+        f.write(json.dumps({"timestamp": "2", "kept": "1", "dedup": 2.0}) + "\n")
+        f.write(json.dumps({"timestamp": "4", "kept": "3"}) + "\n")
+        f.write('{"timestamp": "5", "ke')  # Truncated line left by an interrupted run
+
+    assert load_duplicates(str(tmp_path)) == {"2.png": "1.png", "4.png": "3.png"}
+    assert list_images(str(tmp_path)) == ["1.png", "3.png"]
+    assert list_images(str(tmp_path), duplicates=True) == ["1.png", "2.png", "3.png", "4.png"]
+    assert read_image(str(tmp_path), "2.png") == b"1.png"
+    assert read_image(str(tmp_path), "3.png") == b"3.png"
+
+
+def test_cocostream(tmp_path):
+    path = os.path.join(os.path.dirname(__file__), "gt", "images-interp.json")
+    with open(path, "r", encoding="utf-8") as f:
+        content = f.read()
+
+    # Small chunks exercise values split across reads
+    with patch.object(cocostream, "CHUNK_SIZE", 7):
+        assert [x["id"] for x in cocostream.iter_array(path, "annotations")] == [x["id"] for x in json.loads(content)["annotations"]]
+        output = io.StringIO()
+        cocostream.write_document(output, cocostream.iter_document(path), ensure_ascii=False)
+    assert output.getvalue() == content
+
+    # Numbers cut right after their decimal point or exponent mark by a chunk boundary
+    numbers = {"a": [1.5, 2, -3.25e-7, 4E+2, 10], "b": 6.75}
+    with open(os.path.join(tmp_path, "numbers.json"), "w") as f:
+        f.write(json.dumps(numbers, separators=(",", ":")))
+    for size in range(1, 8):
+        with patch.object(cocostream, "CHUNK_SIZE", size):
+            assert cocostream.read_values(os.path.join(tmp_path, "numbers.json"), ["a", "b"]) == numbers
+
+
+class StubTensor:
+    def __init__(self, array):
+        self.array = array
+
+    def __gt__(self, other):
+        return StubTensor(self.array > other)
+
+    def cpu(self):
+        return self
+
+    def numpy(self):
+        return self.array
+
+
+class StubResult:
+    def __init__(self, image):
+        self.boxes = type("Boxes", (), {"conf": StubTensor(numpy.zeros(0)), "cls": StubTensor(numpy.zeros(0)), "id": None, "xyxy": StubTensor(numpy.zeros((0, 4)))})()
+        self.names = {}
+        self.orig_shape = image.shape[:2]
+        self.speed = {"preprocess": 0.0, "inference": 0.0, "postprocess": 0.0}
+
+
+class StubModel:
+    def __init__(self):
+        self.predictor = None
+        self.tracked = 0
+
+    def track(self, images, **kwargs):
+        self.tracked += len(images)
+        return [StubResult(image) for image in images]
+
+
+def test_autolabel_cache(tmp_path):
+    for i in range(3):
+        cv2.imwrite(str(tmp_path / f"{i:04d}.png"), numpy.full((8, 8, 3), i, numpy.uint8))
+
+    def run():
+        model = StubModel()
+        run_yolo(model, str(tmp_path), 0.5, batch_size=2)
+        return model.tracked
+
+    assert run() == 3
+    assert run() == 0
+    # Any change in the sequence invalidates the whole folder, so track ids stay consistent
+    cv2.imwrite(str(tmp_path / "0001.png"), numpy.full((8, 8, 3), 9, numpy.uint8))
+    assert run() == 3
+    os.remove(tmp_path / "0002.png")
+    assert run() == 2
+    assert run() == 0
+    cv2.imwrite(str(tmp_path / "0003.png"), numpy.zeros((8, 8, 3), numpy.uint8))
+    assert run() == 3
+    os.remove(tmp_path / "0000.json")
+    assert run() == 3